@@ -0,0 +1,339 @@
+"""Offline benchmark of the sshUTXOracle pipeline against a replayed node.
+
+Answers come from a fixture directory, either recorded from a real node with
+`sshUTXOracle.py --record DIR` or generated here as a deterministic synthetic
+chain. Each phase is timed on its own and the price estimates are checked
+against expected.json in the fixture directory. A generated default chain gets
+the expected prices committed below.
+"""
+import sys
+import os
+import time
+import json
+import random
+import hashlib
+import struct
+import argparse
+import tempfile
+from datetime import datetime, timezone, timedelta
+
+import sshUTXOracle as oracle
+
+###############################################################################
+# Synthetic chain
+###############################################################################
+
+def sha256d(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def varint(n):
+    if n < 0xfd:
+        return bytes([n])
+    if n <= 0xffff:
+        return b'\xfd' + struct.pack('<H', n)
+    return b'\xfe' + struct.pack('<I', n)
+
+def output_script(rng, kind):
+    """Serialized scriptPubKey and its verbose JSON for a p2wpkh, p2tr or OP_RETURN output."""
+    if kind == 'p2wpkh':
+        key_hash = rng.randbytes(20)
+        script = b'\x00\x14' + key_hash
+        return script, {'asm': '0 ' + key_hash.hex(), 'hex': script.hex(), 'type': 'witness_v0_keyhash'}
+    if kind == 'p2tr':
+        key = rng.randbytes(32)
+        script = b'\x51\x20' + key
+        return script, {'asm': '1 ' + key.hex(), 'hex': script.hex(), 'type': 'witness_v1_taproot'}
+    data = rng.randbytes(20)
+    script = b'\x6a\x14' + data
+    return script, {'asm': 'OP_RETURN ' + data.hex(), 'hex': script.hex(), 'type': 'nulldata'}
+
+def make_transaction(rng, inputs, outputs, witnesses):
+    """Build one transaction as (txid, serialized bytes, verbosity-2 JSON).
+
+    inputs are (prev_txid, vout) pairs, or None for a coinbase input; outputs are
+    (sats, kind) pairs; witnesses holds the witness items of each input.
+    """
+    vin_raw = varint(len(inputs))
+    vin_json = []
+    for prevout, witness in zip(inputs, witnesses):
+        if prevout is None:
+            script_sig = rng.randbytes(12)
+            vin_raw += b'\x00' * 32 + b'\xff\xff\xff\xff' + varint(len(script_sig)) + script_sig + b'\xff\xff\xff\xff'
+            vin = {'coinbase': script_sig.hex(), 'sequence': 4294967295}
+        else:
+            prev_txid, vout = prevout
+            vin_raw += bytes.fromhex(prev_txid)[::-1] + struct.pack('<I', vout) + b'\x00' + b'\xfd\xff\xff\xff'
+            vin = {'txid': prev_txid, 'vout': vout, 'scriptSig': {'asm': '', 'hex': ''}, 'sequence': 4294967293}
+        if witness:
+            vin['txinwitness'] = [item.hex() for item in witness]
+        vin_json.append(vin)
+
+    vout_raw = varint(len(outputs))
+    vout_json = []
+    for n, (sats, kind) in enumerate(outputs):
+        script, script_json = output_script(rng, kind)
+        vout_raw += struct.pack('<q', sats) + varint(len(script)) + script
+        vout_json.append({'value': float(f"{sats / 1e8:.8f}"), 'n': n, 'scriptPubKey': script_json})
+
+    version = struct.pack('<i', 2)
+    locktime = struct.pack('<I', 0)
+    txid = sha256d(version + vin_raw + vout_raw + locktime)[::-1].hex()
+    if any(witnesses):
+        witness_raw = b''.join(varint(len(items)) + b''.join(varint(len(item)) + item for item in items)
+                               for items in witnesses)
+        raw = version + b'\x00\x01' + vin_raw + vout_raw + witness_raw + locktime
+    else:
+        raw = version + vin_raw + vout_raw + locktime
+    return txid, raw, {'txid': txid, 'version': 2, 'size': len(raw), 'locktime': 0,
+                       'vin': vin_json, 'vout': vout_json, 'hex': raw.hex()}
+
+usd_amounts = [5, 10, 20, 50, 100, 100, 100, 200, 500, 1000]
+round_btc_sats = [10**5, 2 * 10**5, 10**6, 5 * 10**6, 10**7]
+
+def output_value(rng, price):
+    """An output amount in sats: round USD amounts at price, round BTC amounts, or noise."""
+    r = rng.random()
+    if r < 0.45:
+        return max(1, round(rng.choice(usd_amounts) / price * 1e8 * (1 + rng.gauss(0, 0.003))))
+    if r < 0.55:
+        return rng.choice(round_btc_sats)
+    return max(1, int(10 ** rng.uniform(2.5, 9)))
+
+# Prices of the default synthetic chain (--start 2024-03-11 --days 2 --txs-per-block 300
+# --price 60000 --seed 1) at 200 bins per decade, as found by the baseline script's
+# Parts 6-9 over the same blocks
+default_chain = ('2024-03-11', 2, 300, 60000.0, 1)
+default_chain_prices = {'2024-03-11': 59595, '2024-03-12': 59595}
+
+def generate_fixtures(directory, first_day, days, txs_per_block, price, seed):
+    """Write the node answers of a synthetic chain covering the given UTC days.
+
+    The chain starts at header_index_start_height a few hours before first_day and
+    runs a few hours past the last day, with roughly ten minute block intervals and
+    block times that are not monotonic.
+    """
+    rng = random.Random(seed)
+    recorder = oracle.FixtureRecorder(directory)
+    start_time = int(first_day.timestamp()) - 4 * 3600
+    end_time = int((first_day + timedelta(days=days)).timestamp()) + 4 * 3600
+
+    height = oracle.header_index_start_height
+    chain_time = start_time
+    previous_hash = b'\x00' * 32
+    recent_txids = []
+    while chain_time < end_time:
+        chain_time += int(rng.expovariate(1 / 600))
+        block_time = chain_time + rng.randint(-900, 300)
+
+        coinbase = make_transaction(rng, [None], [(312500000, 'p2wpkh'), (0, 'nulldata')], [[b'\x00' * 32]])
+        transactions = [coinbase]
+        block_txids = []
+        for _ in range(txs_per_block):
+            inputs = []
+            for _ in range(rng.choice([1, 1, 1, 2, 2, 3, 6])):
+                r = rng.random()
+                if recent_txids and r < 0.25:
+                    inputs.append((rng.choice(recent_txids[-3000:]), 0))
+                elif block_txids and r < 0.35:
+                    inputs.append((rng.choice(block_txids), 1))
+                else:
+                    inputs.append((rng.randbytes(32).hex(), rng.randint(0, 3)))
+            outputs = []
+            for _ in range(rng.choice([1, 2, 2, 2, 2, 2, 3])):
+                kind = rng.choices(['p2wpkh', 'p2tr', 'nulldata'], [64, 32, 4])[0]
+                outputs.append((0 if kind == 'nulldata' else output_value(rng, price), kind))
+            witnesses = []
+            for _ in inputs:
+                w = rng.random()
+                if w < 0.15:
+                    witnesses.append([])
+                elif w < 0.2:
+                    witnesses.append([rng.randbytes(rng.choice([250, 251, 300]))])
+                else:
+                    witnesses.append([rng.randbytes(71), rng.randbytes(33)])
+            transactions.append(make_transaction(rng, inputs, outputs, witnesses))
+            block_txids.append(transactions[-1][0])
+        recent_txids.extend(block_txids)
+
+        merkle_root = sha256d(b''.join(bytes.fromhex(txid)[::-1] for txid, _, _ in transactions))
+        header = (struct.pack('<i', 0x20000000) + previous_hash + merkle_root +
+                  struct.pack('<III', block_time, 0x17034219, rng.getrandbits(32)))
+        block_hash = sha256d(header)[::-1].hex()
+        header_json = {'hash': block_hash, 'height': height, 'version': 0x20000000, 'time': block_time,
+                       'merkleroot': merkle_root[::-1].hex(), 'nTx': len(transactions),
+                       'previousblockhash': previous_hash[::-1].hex()}
+        raw_block = header + varint(len(transactions)) + b''.join(raw for _, raw, _ in transactions)
+
+        recorder.record(['getblockhash', str(height)], block_hash.encode())
+        recorder.record(['getblockheader', block_hash, 'true'], json.dumps(header_json, indent=2).encode())
+        recorder.record(['getblock', block_hash, '0'], raw_block.hex().encode())
+        block_json = dict(header_json, tx=[tx_json for _, _, tx_json in transactions])
+        recorder.record(['getblock', block_hash, '2'], json.dumps(block_json, indent=2).encode())
+
+        previous_hash = sha256d(header)
+        height += 1
+
+    recorder.record(['getblockcount'], str(height - 1).encode())
+    print(f"Generated blocks {oracle.header_index_start_height}-{height - 1} in {directory}")
+
+###############################################################################
+# Benchmark
+###############################################################################
+
+def timed(timings, phase, function, *args):
+    """Call function(*args), adding its wall time to timings[phase]."""
+    start = time.perf_counter()
+    result = function(*args)
+    timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+    return result
+
+def benchmark_day(day, block_count, latest_time_in_seconds, args, timings):
+    """Time each phase of one day's estimate on its own, returning the prices it found."""
+    day_seconds = int(day.timestamp())
+    seconds_in_a_day = 60 * 60 * 24
+
+    # Block search: the node search without an index, and the header index lookup
+    first_block = timed(timings, 'block search', oracle.search_first_block_of_day,
+                        day_seconds, latest_time_in_seconds, block_count)
+    index_first_block = timed(timings, 'header index lookup', oracle.header_index.first_height_at_or_after, day_seconds)
+    last_block = oracle.header_index.first_height_at_or_after(day_seconds + seconds_in_a_day) - 1
+    if index_first_block != first_block:
+        raise Exception(f"Block search found {first_block} but the header index found {index_first_block}")
+    block_hashes = [oracle.header_index.hash_at(h) for h in range(first_block, last_block + 1)]
+
+    # Fetch: one getblock per block, serially, as raw hex and as verbose JSON
+    raw_answers = timed(timings, 'fetch raw', lambda: [oracle.Ask_Node(['getblock', h, '0']) for h in block_hashes])
+    json_answers = timed(timings, 'fetch json', lambda: [oracle.Ask_Node(['getblock', h, '2']) for h in block_hashes])
+
+    # Parse: each block format into BlockCandidates
+    blocks = timed(timings, 'parse raw', lambda: [oracle.extract_raw_block_candidates(bytes.fromhex(a.decode()))
+                                                  for a in raw_answers])
+    timed(timings, 'parse json', lambda: [oracle.extract_block_candidates(json.loads(a)) for a in json_answers])
+    chunk_size = 65536
+    timed(timings, 'parse json-stream', lambda: [
+        oracle.extract_streamed_block_candidates(a[p:p + chunk_size] for p in range(0, len(a), chunk_size))
+        for a in json_answers])
+
+    # Filter/bin: same-day input filter and histogram of the day's blocks, with the
+    # txid table estimate_price uses and with a plain set
+    def filter_and_bin(todays_txids):
+        counts = oracle.empty_bell_curve(len(oracle.output_bell_curve_bins))
+        for block in blocks:
+            oracle.bin_block_outputs(block, todays_txids, oracle.bell_curve_bin_edges, counts)
+        return counts
+    counts = timed(timings, 'filter/bin', filter_and_bin, oracle.same_day_txid_filter(args.txid_bloom))
+    set_counts = timed(timings, 'filter/bin set', filter_and_bin, set())
+    if list(counts) != list(set_counts):
+        raise Exception("The txid filter and a set of txids gave different bell curves")
+
+    # Stencil fit: Parts 7-9 (which modify the curve, so each repeat gets a copy)
+    fit_price = None
+    for _ in range(args.fit_repeat):
+        fit_price = timed(timings, 'stencil fit', oracle.fit_bell_curve, counts.copy())['price']
+
+    # End to end: estimate_price with the prefetching fetcher
+    estimate_args = argparse.Namespace(fetch_threads=args.fetch_threads, prefetch=args.prefetch, block_format='raw',
+                                       txid_bloom=args.txid_bloom)
+    result = timed(timings, 'end to end', oracle.estimate_price, day, block_count, latest_time_in_seconds,
+                   estimate_args, False)
+    if result['price'] != fit_price:
+        raise Exception(f"estimate_price gave ${result['price']:,} but the phases gave ${fit_price:,}")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of sshUTXOracle against recorded node answers")
+    parser.add_argument('--fixtures', type=str, default='benchmark-fixtures',
+                        help="fixture directory, recorded with sshUTXOracle.py --record or generated here "
+                             "if it does not exist (default: benchmark-fixtures)")
+    parser.add_argument('--start', type=str, default='2024-03-11',
+                        help="first UTC day to estimate (default: 2024-03-11)")
+    parser.add_argument('--days', type=int, default=2, help="number of days to estimate (default: 2)")
+    parser.add_argument('--txs-per-block', type=int, default=300,
+                        help="transactions per generated block (default: 300)")
+    parser.add_argument('--price', type=float, default=60000.0, help="USD price of generated outputs (default: 60000)")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the generated chain (default: 1)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="milliseconds added to each replayed call or batch (default: 0)")
+    parser.add_argument('--fetch-threads', type=int, default=4,
+                        help="fetch threads for the end to end phase (default: 4)")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="blocks requested ahead in the end to end phase (default: 8)")
+    parser.add_argument('--txid-bloom', action='store_true',
+                        help="check a Bloom filter before the same-day txid table")
+    parser.add_argument('--fit-repeat', type=int, default=10,
+                        help="stencil fits timed per day (default: 10)")
+    parser.add_argument('--bins-per-decade', type=int, default=200,
+                        help="bell curve and stencil resolution (default: 200)")
+    parser.add_argument('--sub-bin', action='store_true',
+                        help="interpolate the price between bins")
+    parser.add_argument('--update-expected', action='store_true',
+                        help="write the prices found to the expected file instead of checking them")
+    args = parser.parse_args()
+
+    first_day = datetime.strptime(args.start, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    days = [first_day + timedelta(days=n) for n in range(args.days)]
+    if not os.path.isdir(args.fixtures):
+        generate_fixtures(args.fixtures, first_day, args.days, args.txs_per_block, args.price, args.seed)
+        if (args.start, args.days, args.txs_per_block, args.price, args.seed) == default_chain:
+            with open(os.path.join(args.fixtures, 'expected.json'), 'w') as f:
+                json.dump(default_chain_prices, f, indent=2, sort_keys=True)
+
+    try:
+        oracle.initialize_fit(args)
+    except ValueError as e:
+        print(e)
+        return 1
+    oracle.replay_node = oracle.ReplayNode(args.fixtures, args.latency / 1000)
+    timings = {}
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        oracle.header_index = oracle.HeaderIndex(os.path.join(cache_dir, 'headers.dat'),
+                                                 oracle.header_index_start_height)
+        block_count = int(oracle.Ask_Node(['getblockcount']))
+        timed(timings, 'header index build', oracle.header_index.update, block_count)
+        latest_time_in_seconds = oracle.header_index.time_at(block_count)
+        for day in days:
+            result = benchmark_day(day, block_count, latest_time_in_seconds, args, timings)
+            print(f"{result['date']}: ${result['price']:,} (blocks {result['first_block']}-{result['last_block']})")
+            results.append(result)
+
+    print(f"\n{'phase':<22}{'seconds':>10}{'per day':>10}")
+    for phase, seconds in timings.items():
+        print(f"{phase:<22}{seconds:>10.3f}{seconds / len(days):>10.3f}")
+
+    # Check the prices against the ones recorded with the fixtures
+    prices = {result['date']: result['price'] for result in results}
+    # Other fit settings find other prices, so they are checked against their own file
+    expected_name = 'expected'
+    if args.bins_per_decade != 200:
+        expected_name += f'-{args.bins_per_decade}'
+    if args.sub_bin:
+        expected_name += '-sub-bin'
+    expected_path = os.path.join(args.fixtures, expected_name + '.json')
+    if not args.update_expected and not os.path.exists(expected_path):
+        print(f"\nNo expected prices in {expected_path}: check the prices above against another")
+        print("source and write them with --update-expected")
+        return 1
+    if args.update_expected:
+        expected = {}
+        if os.path.exists(expected_path):
+            with open(expected_path) as f:
+                expected = json.load(f)
+        expected.update(prices)
+        with open(expected_path, 'w') as f:
+            json.dump(expected, f, indent=2, sort_keys=True)
+        print(f"\nWrote expected prices to {expected_path}")
+        return 0
+
+    with open(expected_path) as f:
+        expected = json.load(f)
+    changed = [date for date in prices if date in expected and expected[date] != prices[date]]
+    for date in changed:
+        print(f"Price changed on {date}: expected ${expected[date]:,}, got ${prices[date]:,}")
+    if changed:
+        return 1
+    print(f"\nPrices unchanged for {len([date for date in prices if date in expected])} days")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,20 +1,239 @@
-import paramiko
 import sys
 import time
 from datetime import datetime, timezone, timedelta
 import json
-from math import log10
 import argparse
 import ipaddress  # For IP address validation
+import base64
+import http.client
+import shlex
+import hashlib
+import re
+import codecs
+import queue
+import threading
+import os
+import struct
+import inspect
+import io
+import mmap
+from array import array
+from bisect import bisect_left, bisect_right
 
-# Global SSH client
+try:
+    import numpy as np
+except ImportError:
+    np = None  # binning falls back to bisect over the bin edges
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # no file locks (Windows): don't grow the day store from several processes
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Global SSH client, to the first host given to --ip
 ssh = None
+ssh_host = None
+
+# paramiko is imported by initialize_ssh, so uses without SSH (--replay, Oracle) start fast
+paramiko = None
+
+# Global JSON-RPC tunnel over the SSH connection (None means use podman exec)
+rpc = None
+
+# Further hosts given to --ip, each a NodeConnection; block fetches fan out over the
+# first host and these (see fetch_blocks_fanout)
+fanout_nodes = []
+
+# The NodeConnection a thread's node calls go to, if not the first host (see bind_node)
+bound_node = threading.local()
+
+# Recorded-fixture stand-in for the node, and recorder of live answers (see initialize_node)
+replay_node = None
+fixture_recorder = None
+
+# Number of getblockhash/getblockheader calls sent per batched round trip
+block_hash_batch_size = 16
+
+# With several hosts, a block fetch taking slow_fetch_factor times the median fetch (and at
+# least slow_fetch_seconds) is moved to another host (see fetch_blocks_fanout)
+slow_fetch_factor = 4
+slow_fetch_seconds = 5.0
+
+# The header index starts a little before the earliest supported price date (2023-12-15)
+header_index_start_height = 819000
+header_index_batch_size = 500
 
 # Global bitcoin_cli_options (uncomment and configure if needed)
 # bitcoin_cli_options = ["-rpcuser=user", "-rpcpassword=pass"]
 # not needed when using ssh into start9 node.
 bitcoin_cli_options = []
 
+# Upper bounds (seconds) of the latency histogram buckets kept by PipelineStats
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class LatencyHistogram:
+    """Count and total of timed observations, bucketed by latency_buckets."""
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(latency_buckets) + 1)  # the last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.bucket_counts[bisect_left(latency_buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (inf past the last bucket)."""
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(latency_buckets + (float('inf'),), self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def merge(self, other):
+        self.bucket_counts = [a + b for a, b in zip(self.bucket_counts, other['bucket_counts'])]
+        self.count += other['count']
+        self.total += other['total']
+
+    def to_dict(self):
+        return {'bucket_counts': list(self.bucket_counts), 'count': self.count, 'total': self.total}
+
+class PipelineStats:
+    """Instrumentation of node calls and pipeline phases, shared by all threads.
+
+    Node calls are keyed by (transport, method) with their round trips, calls
+    (a batched round trip holds several), errors, bytes received and latency.
+    Phases are keyed by name, timed per Part or per block.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.node_calls = {}  # (transport, method) -> {'calls', 'errors', 'bytes', 'latency'}
+            self.phases = {}  # phase -> LatencyHistogram
+
+    def observe_node_call(self, transport, command, seconds, received_bytes, calls=1, failed=False):
+        method = command[0].decode('utf-8') if isinstance(command[0], bytes) else str(command[0])
+        with self.lock:
+            entry = self.node_calls.get((transport, method))
+            if entry is None:
+                entry = {'calls': 0, 'errors': 0, 'bytes': 0, 'latency': LatencyHistogram()}
+                self.node_calls[(transport, method)] = entry
+            entry['calls'] += calls
+            entry['errors'] += int(failed)
+            entry['bytes'] += received_bytes
+            entry['latency'].observe(seconds)
+
+    def observe_phase(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = LatencyHistogram()
+            self.phases[phase].observe(seconds)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'node_calls': [{'transport': transport, 'method': method, 'calls': entry['calls'],
+                                'errors': entry['errors'], 'bytes': entry['bytes'],
+                                'latency': entry['latency'].to_dict()}
+                               for (transport, method), entry in sorted(self.node_calls.items())],
+                'phases': [dict(phase=phase, **histogram.to_dict()) for phase, histogram in self.phases.items()],
+                'latency_buckets': list(latency_buckets),
+            }
+
+    def merge(self, other):
+        """Add the to_dict() snapshot of another process's stats (a batch worker's)."""
+        with self.lock:
+            for call in other['node_calls']:
+                entry = self.node_calls.get((call['transport'], call['method']))
+                if entry is None:
+                    entry = {'calls': 0, 'errors': 0, 'bytes': 0, 'latency': LatencyHistogram()}
+                    self.node_calls[(call['transport'], call['method'])] = entry
+                entry['calls'] += call['calls']
+                entry['errors'] += call['errors']
+                entry['bytes'] += call['bytes']
+                entry['latency'].merge(call['latency'])
+            for phase in other['phases']:
+                self.phases.setdefault(phase['phase'], LatencyHistogram()).merge(phase)
+
+    def summary(self):
+        """Human readable tables of the node calls and phases."""
+        lines = [f"\n{'node call':<28}{'calls':>8}{'trips':>8}{'errors':>8}{'MB':>10}"
+                 f"{'total s':>10}{'mean ms':>10}{'p95 ms':>10}"]
+        with self.lock:
+            for (transport, method), entry in sorted(self.node_calls.items()):
+                latency = entry['latency']
+                lines.append(f"{transport + ' ' + method:<28}{entry['calls']:>8}{latency.count:>8}"
+                             f"{entry['errors']:>8}{entry['bytes'] / 1e6:>10.2f}{latency.total:>10.2f}"
+                             f"{1000 * latency.total / latency.count:>10.1f}"
+                             f"{1000 * latency.quantile(0.95):>10.0f}")
+            lines.append(f"\n{'phase':<28}{'count':>8}{'total s':>10}{'mean ms':>10}{'p95 ms':>10}")
+            for phase, latency in self.phases.items():
+                lines.append(f"{phase:<28}{latency.count:>8}{latency.total:>10.2f}"
+                             f"{1000 * latency.total / latency.count:>10.1f}{1000 * latency.quantile(0.95):>10.0f}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """The stats in the Prometheus text exposition format."""
+        def histogram_lines(name, labels, histogram):
+            lines = []
+            cumulative = 0
+            for bound, bucket_count in zip(latency_buckets + (float('inf'),), histogram.bucket_counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {histogram.total!r}')
+            lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+            return lines
+
+        node_lines = {'calls': [], 'errors': [], 'bytes': [], 'latency': []}
+        phase_lines = []
+        with self.lock:
+            for (transport, method), entry in sorted(self.node_calls.items()):
+                labels = f'transport="{transport}",method="{method}"'
+                node_lines['calls'].append(f'utxoracle_node_calls_total{{{labels}}} {entry["calls"]}')
+                node_lines['errors'].append(f'utxoracle_node_call_errors_total{{{labels}}} {entry["errors"]}')
+                node_lines['bytes'].append(f'utxoracle_node_received_bytes_total{{{labels}}} {entry["bytes"]}')
+                node_lines['latency'] += histogram_lines('utxoracle_node_round_trip_seconds', labels, entry['latency'])
+            for phase, histogram in self.phases.items():
+                phase_lines += histogram_lines('utxoracle_phase_seconds', f'phase="{phase}"', histogram)
+
+        lines = ['# HELP utxoracle_node_calls_total bitcoin-cli commands answered by the node.',
+                 '# TYPE utxoracle_node_calls_total counter'] + node_lines['calls']
+        lines += ['# HELP utxoracle_node_call_errors_total Node round trips that failed.',
+                  '# TYPE utxoracle_node_call_errors_total counter'] + node_lines['errors']
+        lines += ['# HELP utxoracle_node_received_bytes_total Bytes of answers received from the node.',
+                  '# TYPE utxoracle_node_received_bytes_total counter'] + node_lines['bytes']
+        lines += ['# HELP utxoracle_node_round_trip_seconds Latency of node round trips (a batch is one).',
+                  '# TYPE utxoracle_node_round_trip_seconds histogram'] + node_lines['latency']
+        lines += ['# HELP utxoracle_phase_seconds Time spent in each pipeline phase.',
+                  '# TYPE utxoracle_phase_seconds histogram'] + phase_lines
+        return '\n'.join(lines) + '\n'
+
+# Global instrumentation of node calls and pipeline phases
+stats = PipelineStats()
+
+def node_transport():
+    """Name of the transport node calls currently go through, for the stats (with the host
+    when fanning out over several)."""
+    if replay_node is not None:
+        return 'replay'
+    transport = 'rpc' if node_connection()[1] is not None else 'exec'
+    if fanout_nodes:
+        transport += '@' + node_host()
+    return transport
+
 def validate_ip(ip):
     """Validate that the provided IP address is a valid IPv4 address."""
     try:
@@ -23,16 +242,17 @@ def validate_ip(ip):
     except ipaddress.AddressValueError:
         return False
 
-def initialize_ssh(ip_address):
-    """Initialize the global SSH connection with the specified IP address."""
-    global ssh
+def open_ssh(ip_address):
+    """Open an SSH connection to the node at the specified IP address."""
+    global paramiko
+    import paramiko
     if not validate_ip(ip_address):
         print(f"Error: Invalid IP address '{ip_address}'. Please provide a valid IPv4 address.")
         sys.exit(1)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
     try:
-        ssh.connect(ip_address, username='start9')
+        client.connect(ip_address, username='start9')
         print(f"SSH connection successful to {ip_address}")
     except paramiko.AuthenticationException:
         print("Error: SSH authentication failed (check username/password)")
@@ -40,42 +260,495 @@ def initialize_ssh(ip_address):
     except paramiko.SSHException as e:
         print(f"Error: SSH connection failed - {str(e)}")
         sys.exit(1)
+    return client
+
+def initialize_ssh(ip_address):
+    """Initialize the global SSH connection with the specified IP address."""
+    global ssh, ssh_host
+    ssh = open_ssh(ip_address)
+    ssh_host = ip_address
 
 def close_ssh():
-    """Close the global SSH connection if open."""
-    global ssh
+    """Close the SSH connections (and RPC tunnels) if open, the further hosts' too."""
+    global ssh, rpc, fanout_nodes
+    for node in fanout_nodes:
+        node.close()
+    fanout_nodes = []
+    if rpc is not None:
+        rpc.close()
+        rpc = None
     if ssh is not None:
         ssh.close()
         print("SSH connection closed")
         ssh = None
 
+class NodeConnection:
+    """SSH connection, RPC tunnel and agent path of a further host given to --ip.
+
+    The first host's are the ssh, rpc and agent_path globals. A thread bound to a
+    NodeConnection with bind_node() sends its node calls to that host instead.
+    """
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.ssh = None
+        self.rpc = None
+        self.agent_path = None
+
+    def close(self):
+        if self.rpc is not None:
+            self.rpc.close()
+            self.rpc = None
+        if self.ssh is not None:
+            self.ssh.close()
+            self.ssh = None
+
+def bind_node(node):
+    """Send this thread's node calls to node (None for the first host), returning the previous binding."""
+    previous = getattr(bound_node, 'node', None)
+    bound_node.node = node
+    return previous
+
+def node_connection():
+    """The (ssh, rpc, agent_path) of the host this thread's node calls go to."""
+    node = getattr(bound_node, 'node', None)
+    if node is None:
+        return ssh, rpc, agent_path
+    return node.ssh, node.rpc, node.agent_path
+
+def node_host():
+    """The host this thread's node calls go to."""
+    node = getattr(bound_node, 'node', None)
+    return ssh_host if node is None else node.ip
+
+def close_node():
+    """Close the SSH connection and forget the replay node, recorder and agent."""
+    global replay_node, fixture_recorder, agent_path
+    close_ssh()
+    replay_node = None
+    fixture_recorder = None
+    agent_path = None
+
+class ChannelHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection whose socket is a direct-tcpip channel on the SSH transport."""
+
+    def __init__(self, transport, host, port, timeout=300):
+        super().__init__(host, port, timeout=timeout)
+        self.ssh_transport = transport
+
+    def connect(self):
+        self.sock = self.ssh_transport.open_channel(
+            'direct-tcpip', (self.host, self.port), ('127.0.0.1', 0), timeout=self.timeout)
+        self.sock.settimeout(self.timeout)
+
+class RpcTunnel:
+    """Keep-alive JSON-RPC sessions to bitcoind, forwarded through the SSH connection.
+
+    Each concurrent caller gets its own channel from a pool of idle connections.
+    """
+
+    def __init__(self, transport, host, port, user, password):
+        self.transport = transport
+        self.host = host
+        self.port = port
+        self.idle_connections = queue.LifoQueue()
+        token = base64.b64encode(f"{user}:{password}".encode()).decode()
+        self.headers = {'Authorization': 'Basic ' + token, 'Content-Type': 'application/json'}
+
+    def post(self, payload):
+        body = json.dumps(payload).encode()
+        try:
+            connection = self.idle_connections.get_nowait()
+        except queue.Empty:
+            connection = ChannelHTTPConnection(self.transport, self.host, self.port)
+        try:
+            connection.request('POST', '/', body, self.headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            # The keep-alive channel was dropped; reconnect once and retry
+            connection.close()
+            connection.request('POST', '/', body, self.headers)
+            response = connection.getresponse()
+            data = response.read()
+        self.idle_connections.put(connection)
+        if response.status == 401:
+            raise Exception("RPC authentication failed (check --rpc-user/--rpc-password)")
+        if not data:
+            raise Exception(f"RPC request failed with HTTP status {response.status}")
+        return json.loads(data)
+
+    def batch(self, calls, errors_as_none=False):
+        """Send [(method, params), ...] in one round trip and return the results in order.
+
+        A call that fails raises, or with errors_as_none gives None and the others their results.
+        """
+        if not calls:
+            return []
+        payload = [{'jsonrpc': '1.0', 'id': i, 'method': method, 'params': params}
+                   for i, (method, params) in enumerate(calls)]
+        replies = self.post(payload)
+        if isinstance(replies, dict):
+            raise Exception(f"RPC error: {replies.get('error')}")
+        results = [None] * len(calls)
+        for reply in replies:
+            if reply.get('error'):
+                if errors_as_none:
+                    continue
+                raise Exception(f"RPC error: {reply['error'].get('message', reply['error'])}")
+            results[reply['id']] = reply['result']
+        return results
+
+    def call(self, method, params):
+        return self.batch([(method, params)])[0]
+
+    def stream(self, method, params, chunk_size=65536):
+        """Send one call and yield the raw JSON-RPC reply in chunks as they arrive."""
+        body = json.dumps({'jsonrpc': '1.0', 'id': 0, 'method': method, 'params': params}).encode()
+        try:
+            connection = self.idle_connections.get_nowait()
+        except queue.Empty:
+            connection = ChannelHTTPConnection(self.transport, self.host, self.port)
+        try:
+            connection.request('POST', '/', body, self.headers)
+            response = connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            connection.request('POST', '/', body, self.headers)
+            response = connection.getresponse()
+        if response.status == 401:
+            connection.close()
+            raise Exception("RPC authentication failed (check --rpc-user/--rpc-password)")
+        completed = False
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            completed = True
+        finally:
+            if completed:
+                self.idle_connections.put(connection)
+            else:
+                connection.close()
+
+    def close(self):
+        while not self.idle_connections.empty():
+            self.idle_connections.get_nowait().close()
+
+# Positional arguments that bitcoin-cli sends as JSON values rather than strings
+rpc_convert_params = {
+    'getblockhash': {0},
+    'getblockheader': {1},
+    'getblock': {1},
+    'getrawmempool': {0, 1},
+    'getrawtransaction': {1},
+}
+
+def rpc_request(command):
+    """Convert a bitcoin-cli style argument list into an RPC method and params."""
+    args = [arg.decode('utf-8') if isinstance(arg, bytes) else str(arg) for arg in command]
+    method = args[0]
+    convert = rpc_convert_params.get(method, set())
+    params = [json.loads(arg) if i in convert else arg for i, arg in enumerate(args[1:])]
+    return method, params
+
+def rpc_answer(result):
+    """Format an RPC result the way bitcoin-cli prints it, as bytes."""
+    if result is None:
+        return b''
+    if isinstance(result, str):
+        return result.encode()
+    return json.dumps(result).encode()
+
+def open_rpc(args):
+    """Open the JSON-RPC tunnel over this thread's host's SSH connection, or return None
+    to use podman exec when --transport is auto (or exec)."""
+    if args.transport == 'exec':
+        return None
+    try:
+        user, password = args.rpc_user, args.rpc_password
+        if user is None or password is None:
+            # Nodes set up with rpcuser/rpcpassword have no cookie: only the line below reports it
+            cookie = Ask_Node_Exec(['cat', args.rpc_cookie], program='', quiet=True)
+            user, password = cookie.decode().split(':', 1)
+        tunnel = RpcTunnel(node_connection()[0].get_transport(), args.rpc_host, args.rpc_port, user, password)
+        tunnel.call('getblockcount', [])
+        print(f"RPC tunnel open to {args.rpc_host}:{args.rpc_port}")
+        return tunnel
+    except Exception as e:
+        if args.transport == 'rpc':
+            print(f"Error: RPC tunnel to {args.rpc_host}:{args.rpc_port} failed - {str(e)}")
+            sys.exit(1)
+        print(f"RPC tunnel unavailable ({str(e)}), using podman exec")
+        return None
+
+def initialize_rpc(args):
+    """Open the JSON-RPC tunnel, falling back to podman exec when --transport is auto."""
+    global rpc
+    rpc = open_rpc(args)
+
+def connect_fanout_node(ip_address, args):
+    """Open a further --ip host's SSH connection and RPC tunnel."""
+    node = NodeConnection(ip_address)
+    node.ssh = open_ssh(ip_address)
+    previous = bind_node(node)
+    try:
+        node.rpc = open_rpc(args)
+    except BaseException:
+        node.close()
+        raise
+    finally:
+        bind_node(previous)
+    return node
+
 def Ask_Node(command):
-    """Execute a bitcoin-cli command via SSH using the global SSH connection."""
-    global ssh
-    if ssh is None:
+    """Execute a bitcoin-cli command via the replay node, the RPC tunnel, or SSH podman exec."""
+    transport = node_transport()
+    tunnel = node_connection()[1]
+    started = time.perf_counter()
+    try:
+        if replay_node is not None:
+            answer = replay_node.answer(command)
+        elif tunnel is not None:
+            answer = rpc_answer(tunnel.call(*rpc_request(command)))
+        else:
+            answer = Ask_Node_Exec(command)
+    except Exception:
+        stats.observe_node_call(transport, command, time.perf_counter() - started, 0, failed=True)
+        raise
+    stats.observe_node_call(transport, command, time.perf_counter() - started, len(answer))
+    if fixture_recorder is not None:
+        fixture_recorder.record(command, answer)
+    return answer
+
+def Ask_Node_Batch(commands, missing_ok=False):
+    """Execute several bitcoin-cli commands in a single round trip, answers in order.
+
+    With missing_ok, a command that fails (e.g. a transaction no longer in the mempool)
+    answers None instead of failing the batch.
+    """
+    if not commands:
+        return []
+    transport = node_transport() + ' batch'
+    tunnel = node_connection()[1]
+    started = time.perf_counter()
+    try:
+        if replay_node is not None:
+            answers = replay_node.answer_batch(commands, missing_ok)
+        elif tunnel is not None:
+            results = tunnel.batch([rpc_request(c) for c in commands], errors_as_none=missing_ok)
+            answers = [None if missing_ok and r is None else rpc_answer(r) for r in results]
+        else:
+            answers = Ask_Node_Exec_Batch(commands, quiet=missing_ok, missing_ok=missing_ok)
+    except Exception:
+        stats.observe_node_call(transport, commands[0], time.perf_counter() - started, 0, len(commands), True)
+        raise
+    stats.observe_node_call(transport, commands[0], time.perf_counter() - started,
+                            sum(len(a) for a in answers if a is not None), len(commands))
+    if fixture_recorder is not None:
+        for command, answer in zip(commands, answers):
+            if answer is not None:
+                fixture_recorder.record(command, answer)
+    return answers
+
+def Ask_Node_Exec_Batch(commands, quiet=False, missing_ok=False):
+    """Run several bitcoin-cli commands inside a single podman exec.
+
+    The script stops at the first failing command, or with missing_ok runs them all
+    and answers None for those that failed.
+    """
+    if len(commands) == 1 and not missing_ok:
+        return [Ask_Node_Exec(commands[0], quiet=quiet)]
+
+    # Run all commands inside one podman exec, separated by a marker line
+    marker = 'UTXORACLE-BATCH-SEPARATOR'
+    failed_marker = 'UTXORACLE-BATCH-FAILED'
+    script = [] if missing_ok else ['set -e']
+    for command in commands:
+        args = [arg.decode('utf-8') if isinstance(arg, bytes) else str(arg) for arg in command]
+        cli_command = ' '.join(['bitcoin-cli'] + [shlex.quote(a) for a in args])
+        if missing_ok:
+            # The error goes nowhere (stderr output fails the exec) and the marker stands in for it
+            cli_command += f' 2>/dev/null || echo {failed_marker}'
+        script.append(cli_command)
+        script.append(f'echo {marker}')
+    output = Ask_Node_Exec(['sh', '-c', '; '.join(script)], program='', quiet=quiet)
+    answers = [a.strip().encode() for a in output.decode().split(marker)][:len(commands)]
+    if missing_ok:
+        answers = [None if answer == failed_marker.encode() else answer for answer in answers]
+    return answers
+
+def fixture_name(command):
+    """File name under which a bitcoin-cli command's answer is recorded."""
+    args = [arg.decode('utf-8') if isinstance(arg, bytes) else str(arg) for arg in command]
+    return hashlib.sha1(' '.join(args).encode()).hexdigest() + '.out'
+
+class FixtureRecorder:
+    """Saves every answer from the node so the run can be replayed offline with ReplayNode."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, command, answer):
+        name = fixture_name(command)
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(answer)
+        args = [arg.decode('utf-8') if isinstance(arg, bytes) else str(arg) for arg in command]
+        with self.lock, open(os.path.join(self.directory, 'commands.txt'), 'a') as f:
+            f.write(f"{name} {' '.join(args)}\n")
+
+class ReplayNode:
+    """Stand-in node answering bitcoin-cli commands from recorded fixture files.
+
+    Every call (or batch of calls) waits latency seconds, like one round trip to the node.
+    """
+
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+
+    def read(self, command):
+        try:
+            with open(os.path.join(self.directory, fixture_name(command)), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            args = [arg.decode('utf-8') if isinstance(arg, bytes) else str(arg) for arg in command]
+            raise Exception(f"bitcoin-cli error: no recorded answer for '{' '.join(args)}'")
+
+    def answer(self, command):
+        time.sleep(self.latency)
+        return self.read(command)
+
+    def answer_batch(self, commands, missing_ok=False):
+        time.sleep(self.latency)
+        answers = []
+        for command in commands:
+            try:
+                answers.append(self.read(command))
+            except Exception:
+                if not missing_ok:
+                    raise
+                answers.append(None)
+        return answers
+
+    def answer_stream(self, command, chunk_size):
+        answer = self.answer(command)
+        for position in range(0, len(answer), chunk_size):
+            yield answer[position:position + chunk_size]
+
+def initialize_node(args):
+    """Connect to the node over SSH (and RPC), or load the replay node given by --replay.
+
+    --ip can list several comma-separated hosts. The first answers everything but
+    block fetches, which fan out over all of them. A further host that cannot be
+    connected to is left out.
+    """
+    global replay_node, fixture_recorder, fanout_nodes
+    if args.replay:
+        replay_node = ReplayNode(args.replay, args.replay_latency / 1000)
+        print(f"Replaying recorded node answers from {args.replay}")
+    else:
+        hosts = [host.strip() for host in args.ip.split(',')]
+        initialize_ssh(hosts[0])
+        initialize_rpc(args)
+        fanout_nodes = []
+        for host in hosts[1:]:
+            try:
+                fanout_nodes.append(connect_fanout_node(host, args))
+            except SystemExit:
+                print(f"Leaving {host} out of block fetches")  # open_ssh has printed why
+            except Exception as e:
+                print(f"Leaving {host} out of block fetches: {str(e)}")
+    if args.record:
+        fixture_recorder = FixtureRecorder(args.record)
+        print(f"Recording node answers to {args.record}")
+    if args.block_format == 'agent':
+        initialize_agent(args)
+
+def build_podman_command(command, program='bitcoin-cli'):
+    """Build the shell command that runs a bitcoin-cli command inside bitcoind.embassy."""
+    # Construct the bitcoin-cli command
+    cli_command = [program] if program else []
+
+    # Add any configuration options from bitcoin_cli_options
+    #for o in bitcoin_cli_options:
+    #    cli_command.append(str(o))
+
+    # Add the user-provided command arguments, decoding bytes to hex if needed
+    for arg in command:
+        if isinstance(arg, bytes):
+            cli_command.append(arg.decode('utf-8'))
+        else:
+            cli_command.append(str(arg))
+
+    # Build the full podman command
+    escaped_cli_command = [shlex.quote(arg) if ' ' in arg else arg for arg in cli_command]
+    return f"sudo podman exec bitcoind.embassy {' '.join(escaped_cli_command)}"
+
+def Ask_Node_Stream(command, chunk_size=65536):
+    """Execute a bitcoin-cli command, yielding its output in chunks as they arrive."""
+    transport = node_transport() + ' stream'
+    started = time.perf_counter()
+    received_bytes = 0
+    completed = False
+    try:
+        for chunk in node_stream_chunks(command, chunk_size):
+            received_bytes += len(chunk)
+            yield chunk
+        completed = True
+    finally:
+        # The time includes the consumer's decoding between chunks
+        stats.observe_node_call(transport, command, time.perf_counter() - started, received_bytes,
+                                failed=not completed)
+
+def node_stream_chunks(command, chunk_size):
+    """Chunks of a bitcoin-cli command's output from the replay node, RPC tunnel or SSH."""
+    if replay_node is not None:
+        yield from replay_node.answer_stream(command, chunk_size)
+        return
+    if fixture_recorder is not None:
+        answer = Ask_Node(command)  # recorded in full; bitcoin-cli prints the same JSON
+        for position in range(0, len(answer), chunk_size):
+            yield answer[position:position + chunk_size]
+        return
+    client, tunnel, _ = node_connection()
+    if tunnel is not None:
+        yield from tunnel.stream(*rpc_request(command), chunk_size=chunk_size)
+        return
+    if client is None:
         raise Exception("SSH connection not initialized")
 
+    stdin, stdout, stderr = client.exec_command(build_podman_command(command))
     try:
-        # Construct the bitcoin-cli command
-        cli_command = ["bitcoin-cli"]
+        while True:
+            chunk = stdout.channel.recv(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        error = stderr.read().decode().strip()
+        if stdout.channel.recv_exit_status() != 0 or error:
+            raise Exception(f"bitcoin-cli error: {error or 'Command failed without specific error'}")
+    finally:
+        stdout.channel.close()
 
-        # Add any configuration options from bitcoin_cli_options
-        #for o in bitcoin_cli_options:
-        #    cli_command.append(str(o))
+def Ask_Node_Exec(command, program='bitcoin-cli', quiet=False):
+    """Execute a bitcoin-cli command via SSH using this thread's host's SSH connection.
 
-        # Add the user-provided command arguments, decoding bytes to hex if needed
-        for arg in command:
-            if isinstance(arg, bytes):
-                cli_command.append(arg.decode('utf-8'))
-            else:
-                cli_command.append(str(arg))
+    With quiet, errors are raised without printing the troubleshooting steps.
+    """
+    client = node_connection()[0]
+    if client is None:
+        raise Exception("SSH connection not initialized")
 
-        # Build the full podman command
-        escaped_cli_command = [f'"{arg}"' if ' ' in arg else arg for arg in cli_command]
-        podman_command = f"sudo podman exec bitcoind.embassy {' '.join(escaped_cli_command)}"
+    try:
+        podman_command = build_podman_command(command, program)
 
         # Execute the command via SSH
-        stdin, stdout, stderr = ssh.exec_command(podman_command)
+        stdin, stdout, stderr = client.exec_command(podman_command)
 
         # Read output and errors
         output = stdout.read().decode().strip()
@@ -94,9 +767,12 @@ def Ask_Node(command):
         return output.encode()
 
     except paramiko.SSHException as e:
-        print(f"Error executing command: SSH error - {str(e)}")
+        if not quiet:
+            print(f"Error executing command: SSH error - {str(e)}")
         raise
     except Exception as e:
+        if quiet:
+            raise
         print("Error connecting to your node. Troubleshooting steps:")
         print("\t1) Make sure the bitcoind.embassy container is running on the specified IP")
         print("\t2) Verify 'sudo podman exec bitcoind.embassy bitcoin-cli getblockcount' works via SSH")
@@ -106,323 +782,1606 @@ def Ask_Node(command):
         print(f"\nThe error was:\n{str(e)}")
         raise
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="UTXOracle: Estimate Bitcoin price from on-chain data")
-parser.add_argument('--ip', type=str, default='192.168.1.99',
-                    help="IP address of the Bitcoin node (default: 192.168.1.99)")
-args = parser.parse_args()
-
-# Initialize SSH connection with the provided or default IP
-initialize_ssh(args.ip)
-
-try:
-    # Main loop to allow multiple price estimates until 'q'
-    while True:
-        ###############################################################################
-        # Part 2) Get the latest block from the node
-        ###############################################################################
-
-        block_count_b = Ask_Node(['getblockcount'])
-        block_count = int(block_count_b)
-
-        block_hash_b = Ask_Node(['getblockhash', str(block_count)])
-        block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
-        block_header = json.loads(block_header_b)
-
-        latest_time_in_seconds = block_header['time']
-        time_datetime = datetime.fromtimestamp(latest_time_in_seconds, tz=timezone.utc)
-
-        latest_year = int(time_datetime.strftime("%Y"))
-        latest_month = int(time_datetime.strftime("%m"))
-        latest_day = int(time_datetime.strftime("%d"))
-        latest_utc_midnight = datetime(latest_year, latest_month, latest_day, 0, 0, 0, tzinfo=timezone.utc)
-
-        seconds_in_a_day = 60 * 60 * 24
-        yesterday_seconds = latest_time_in_seconds - seconds_in_a_day
-        latest_price_day = datetime.fromtimestamp(yesterday_seconds, tz=timezone.utc)
-        latest_price_date = latest_price_day.strftime("%Y-%m-%d")
-
-        print("UTXOracle version 8")
-        print("\nConnected to local node at block #:\t" + str(block_count))
-        print("Latest available price date:\t\t" + latest_price_date + " (pruned node ok)")
-        print("Earliest available price date:\t\t2023-12-15 (requires full node)")
-
-        ###############################################################################
-        # Part 3) Ask the user for the desired date to estimate the price
-        ###############################################################################
-
-        date_entered = input("\nEnter date in YYYY-MM-DD format\nor Enter 'q' to quit " +
-                             "\nor press ENTER for the most recent price: ")
-
-        if date_entered == 'q':
-            print("Exiting script...")
-            break  # Exit the loop to close SSH and exit
-
-        elif date_entered == "":
-            datetime_entered = latest_utc_midnight + timedelta(days=-1)
-        else:
+class HeaderIndex:
+    """On-disk index of block height -> (header time, block hash) for the active chain.
+
+    Records are fixed width and kept in height order from start_height, so the file
+    is appended to as the chain grows and truncated when a reorg is detected.
+    """
+
+    magic = b'UTXOHIX1'
+    file_header = struct.Struct('<8sI')
+    record = struct.Struct('<I32s')
+
+    def __init__(self, path, start_height):
+        self.path = path
+        self.start_height = start_height
+        self.times = array('I')
+        self.time_ceilings = array('I')  # running max of header times, never decreasing
+        self.hashes = []
+
+        f = self.open_locked()
+        try:
+            f.seek(0)
+            header = f.read(self.file_header.size)
+            if (len(header) == self.file_header.size and
+                    self.file_header.unpack(header) == (self.magic, start_height)):
+                self.reload(f)
+            else:
+                f.truncate(0)
+                f.write(self.file_header.pack(self.magic, start_height))
+        finally:
+            self.close_locked(f)
+
+    def open_locked(self):
+        """Open the index file for update, holding an exclusive lock when fcntl is available.
+
+        A daemon and CLI queries can share one cache dir, so each takes the lock, catches
+        up with what the others wrote (reload) and only then appends or truncates.
+        """
+        f = open(self.path, 'a+b')  # created if missing; writes always go to the end
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def close_locked(self, f):
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    def reload(self, f):
+        """Bring the in-memory records in line with the locked file f.
+
+        Records another process appended are read in; if it rolled back a reorg
+        past our tip, the whole file is read again. A torn record at the end is dropped.
+        """
+        f.seek(0, os.SEEK_END)
+        count = max(0, (f.tell() - self.file_header.size) // self.record.size)
+        known = len(self.times)
+        if known:
+            f.seek(self.file_header.size + (known - 1) * self.record.size)
+            tip_record = f.read(self.record.size)
+            # The same hash at our tip means the same chain below it
+            if count < known or self.record.unpack(tip_record)[1].hex() != self.hashes[-1]:
+                self.drop_from(0)
+                known = 0
+        f.seek(self.file_header.size + known * self.record.size)
+        for header_time, block_hash in self.record.iter_unpack(f.read((count - known) * self.record.size)):
+            self.append(header_time, block_hash.hex())
+        f.truncate(self.file_header.size + count * self.record.size)
+
+    @property
+    def tip_height(self):
+        return self.start_height + len(self.times) - 1
+
+    def time_at(self, height):
+        return self.times[height - self.start_height]
+
+    def hash_at(self, height):
+        return self.hashes[height - self.start_height]
+
+    def first_height_at_or_after(self, timestamp):
+        """First height whose header time (or any before it) is at or after timestamp."""
+        return self.start_height + bisect_left(self.time_ceilings, timestamp)
+
+    def append(self, header_time, block_hash):
+        ceiling = max(header_time, self.time_ceilings[-1]) if self.time_ceilings else header_time
+        self.times.append(header_time)
+        self.time_ceilings.append(ceiling)
+        self.hashes.append(block_hash)
+
+    def drop_from(self, keep):
+        del self.times[keep:]
+        del self.time_ceilings[keep:]
+        del self.hashes[keep:]
+
+    def truncate(self, f, height):
+        """Drop every record at or above height, in memory and in the locked file f."""
+        keep = max(0, height - self.start_height)
+        self.drop_from(keep)
+        f.truncate(self.file_header.size + keep * self.record.size)
+
+    def find_fork_height(self, block_count):
+        """Return the lowest height whose stored hash no longer matches the node."""
+        height = min(self.tip_height, block_count)
+        window = 1  # the tip alone usually proves the whole index is still valid
+        while height >= self.start_height:
+            heights = range(height, max(self.start_height - 1, height - window), -1)
+            node_hashes = Ask_Node_Batch([['getblockhash', str(h)] for h in heights])
+            for h, node_hash in zip(heights, node_hashes):
+                if node_hash.decode() == self.hash_at(h):
+                    return h + 1
+            height = heights[-1] - 1
+            window = block_hash_batch_size
+        return self.start_height
+
+    def update(self, block_count):
+        """Roll back reorged blocks, then extend the index up to block_count."""
+        f = self.open_locked()
+        try:
+            self.reload(f)
+            fork_height = self.find_fork_height(block_count)
+            if fork_height <= self.tip_height:
+                print(f"Header index: reorg detected, dropping heights from {fork_height}")
+                self.truncate(f, fork_height)
+
+            height = self.tip_height + 1
+            total = block_count - height + 1
+            while height <= block_count:
+                if total > header_index_batch_size:
+                    print(f"Building header index: {height - (block_count - total + 1)}/{total} headers")
+                heights = range(height, min(height + header_index_batch_size, block_count + 1))
+                block_hashes = Ask_Node_Batch([['getblockhash', str(h)] for h in heights])
+                block_headers = Ask_Node_Batch([['getblockheader', h, 'true'] for h in block_hashes])
+                for block_hash_b, block_header_b in zip(block_hashes, block_headers):
+                    header_time = json.loads(block_header_b)['time']
+                    self.append(header_time, block_hash_b.decode())
+                    f.write(self.record.pack(header_time, bytes.fromhex(block_hash_b.decode())))
+                f.flush()
+                height = heights[-1] + 1
+        finally:
+            self.close_locked(f)
+
+class BlockCandidates:
+    """The parts of one block the estimator needs, as produced by extract_block_candidates.
+
+    txids holds the last 4 bytes (8 hex digits) of every txid in block order as ints.
+    The transactions that passed the per-transaction filters are kept in flat arrays
+    that numpy can read without copying: tx_indexes, their input txid suffixes
+    (input_counts per transaction, one after another in input_txids) and their output
+    values in sats (output_counts and output_values).
+    """
+
+    magic = b'UTXC'  # UTXB records had no filter version
+    # Bump whenever the Part 6 filters or the record layout change, so older records are cache misses
+    filter_version = 2
+    file_header = struct.Struct('<4sHIII')  # magic, filter version, time, txid and candidate counts
+
+    def __init__(self, time, txids, candidates=()):
+        self.time = time
+        self.txids = txids
+        self.tx_indexes = array('I')
+        self.input_counts = array('B')
+        self.input_txids = array('I')
+        self.output_counts = array('B')
+        self.output_values = array('q')
+        for tx_index, input_txids, output_values in candidates:
+            self.add_candidate(tx_index, input_txids, output_values)
+
+    def add_candidate(self, tx_index, input_txids, output_values):
+        self.tx_indexes.append(tx_index)
+        self.input_counts.append(len(input_txids))
+        self.input_txids.extend(input_txids)
+        self.output_counts.append(len(output_values))
+        self.output_values.extend(output_values)
+
+    @property
+    def candidates(self):
+        """(tx_index, input txid suffixes, output values in sats) per candidate transaction."""
+        candidates = []
+        inputs = outputs = 0
+        for tx_index, input_count, output_count in zip(self.tx_indexes, self.input_counts, self.output_counts):
+            candidates.append((tx_index, tuple(self.input_txids[inputs:inputs + input_count]),
+                               tuple(self.output_values[outputs:outputs + output_count])))
+            inputs += input_count
+            outputs += output_count
+        return candidates
+
+    def to_bytes(self):
+        return b''.join([self.file_header.pack(self.magic, self.filter_version, self.time, len(self.txids),
+                                               len(self.tx_indexes)),
+                         self.txids.tobytes(), self.tx_indexes.tobytes(), self.input_counts.tobytes(),
+                         self.output_counts.tobytes(), self.input_txids.tobytes(), self.output_values.tobytes()])
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, filter_version, time, txid_count, candidate_count = cls.file_header.unpack_from(data)
+        if magic != cls.magic:
+            raise ValueError("not a block candidates record")
+        if filter_version != cls.filter_version:
+            raise ValueError(f"block candidates record from filter version {filter_version}")
+        block = cls(time, array('I'))
+        offset = cls.file_header.size
+
+        def read(values, count):
+            nonlocal offset
+            values.frombytes(data[offset:offset + values.itemsize * count])
+            if len(values) != count:
+                raise ValueError("truncated block candidates record")
+            offset += values.itemsize * count
+
+        read(block.txids, txid_count)
+        read(block.tx_indexes, candidate_count)
+        read(block.input_counts, candidate_count)
+        read(block.output_counts, candidate_count)
+        read(block.input_txids, sum(block.input_counts))
+        read(block.output_values, sum(block.output_counts))
+        return block
+
+class BlockCache:
+    """Size-bounded on-disk LRU cache of BlockCandidates, one file per block hash."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # block hash -> file size, least recently used first
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.bin'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        for _, block_hash, size in sorted(files):
+            self.entries[block_hash] = size
+            self.total_bytes += size
+
+    def path(self, block_hash):
+        return os.path.join(self.directory, block_hash + '.bin')
+
+    def get(self, block_hash):
+        with self.lock:
+            if block_hash not in self.entries:
+                return None
+            self.entries.move_to_end(block_hash)
+        try:
+            with open(self.path(block_hash), 'rb') as f:
+                block = BlockCandidates.from_bytes(f.read())
+            os.utime(self.path(block_hash))
+            return block
+        except (OSError, ValueError, struct.error):
+            # Unreadable, or written by other filters: drop it and fetch the block again
+            with self.lock:
+                self.total_bytes -= self.entries.pop(block_hash, 0)
             try:
-                year = int(date_entered.split('-')[0])
-                month = int(date_entered.split('-')[1])
-                day = int(date_entered.split('-')[2])
-                datetime_entered = datetime(year, month, day, 0, 0, 0, tzinfo=timezone.utc)
-                if datetime_entered.timestamp() > latest_utc_midnight.timestamp():
-                    print("\nThe date entered is not before the current date, please try again")
-                    continue
-                dec_15_2023 = datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)
-                if datetime_entered.timestamp() < dec_15_2023.timestamp():
-                    print("\nThe date entered is before 2023-12-15, please try again")
-                    continue
-            except:
-                print("\nError interpreting date. Please try again. Make sure format is YYYY-MM-DD")
-                continue
-
-        price_day_seconds = int(datetime_entered.timestamp())
-        price_day_date_utc = datetime_entered.strftime("%B %d, %Y")
-        print("\n\n########   Starting Price Estimate   ########")
-
-        ###############################################################################
-        # Part 4) Hunt through blocks to find the first block on the target day
-        ###############################################################################
-
-        seconds_since_price_day = latest_time_in_seconds - price_day_seconds
-        blocks_ago_estimate = round(144 * float(seconds_since_price_day) / float(seconds_in_a_day))
-        price_day_block_estimate = block_count - blocks_ago_estimate
-
+                os.remove(self.path(block_hash))
+            except OSError:
+                pass
+            return None
+
+    def put(self, block_hash, block):
+        data = block.to_bytes()
+        temp_path = self.path(block_hash) + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path(block_hash))
+        with self.lock:
+            self.total_bytes += len(data) - self.entries.pop(block_hash, 0)
+            self.entries[block_hash] = len(data)
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                evicted_hash, size = self.entries.popitem(last=False)
+                self.total_bytes -= size
+                try:
+                    os.remove(self.path(evicted_hash))
+                except FileNotFoundError:
+                    pass
+
+class DayStore:
+    """Memory-mapped file of finished days, one fixed-width record per UTC day.
+
+    Record n holds day first_day + n: its Part 6 bell curve (before Part 7), the
+    block range and last block hash, the tip it was computed against and the
+    price estimate. A stored day can be read back or refitted (Parts 7-9)
+    without the node, as long as its last block is still in the active chain.
+    """
+
+    magic = b'UTXODAY1'
+    file_header = struct.Struct('<8sII')  # magic, first day (days since 1970-01-01), bins per record
+    # stored flag, first block, last block, last block hash, tip height, tip hash, price
+    record_header = struct.Struct('<III32sI32sq')
+    days_per_growth = 128
+
+    def __init__(self, path, number_of_bins, first_day=datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)):
+        self.path = path
+        self.number_of_bins = number_of_bins
+        self.record_size = self.record_header.size + 8 * number_of_bins
+        self.lock = threading.Lock()
+        self.file = open(path, 'a+b')
+        self.file.seek(0)
+        header = self.file.read(self.file_header.size)
+        if len(header) < self.file_header.size:
+            self.first_day_number = int(first_day.timestamp()) // 86400
+            self.file.write(self.file_header.pack(self.magic, self.first_day_number, number_of_bins))
+            self.file.flush()
+        else:
+            magic, self.first_day_number, stored_bins = self.file_header.unpack(header)
+            if magic != self.magic or stored_bins != number_of_bins:
+                raise Exception(f"{path} is not a day store with {number_of_bins} bins")
+        self.map = None
+        self.remap()
+
+    def remap(self):
+        size = os.fstat(self.file.fileno()).st_size
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), size) if size else None
+
+    def offset(self, day):
+        index = int(day.timestamp()) // 86400 - self.first_day_number
+        if index < 0:
+            raise ValueError(f"{day.strftime('%Y-%m-%d')} is before the first day of {self.path}")
+        return self.file_header.size + index * self.record_size
+
+    def get(self, day):
+        """The stored record of a day as a dict (counts is its raw bell curve), or None."""
+        offset = self.offset(day)
+        with self.lock:
+            if offset + self.record_size > len(self.map):
+                self.remap()  # another process may have grown the file
+                if offset + self.record_size > len(self.map):
+                    return None
+            stored, first_block, last_block, last_block_hash, tip_height, tip_hash, price = \
+                self.record_header.unpack_from(self.map, offset)
+            if not stored:
+                return None
+            counts_offset = offset + self.record_header.size
+            if np is not None:
+                counts = np.frombuffer(self.map, dtype='<f8', count=self.number_of_bins, offset=counts_offset).copy()
+            else:
+                counts = array('d', self.map[counts_offset:counts_offset + 8 * self.number_of_bins])
+        return {'date': day.strftime("%Y-%m-%d"), 'price': price, 'first_block': first_block,
+                'last_block': last_block, 'last_block_hash': last_block_hash.hex(),
+                'tip_height': tip_height, 'tip_hash': tip_hash.hex(), 'counts': counts}
+
+    def put(self, day, counts, first_block, last_block, last_block_hash, tip_height, tip_hash, price):
+        offset = self.offset(day)
+        with self.lock:
+            if offset + self.record_size > len(self.map):
+                self.grow(offset + self.record_size)
+            counts_offset = offset + self.record_header.size
+            self.map[counts_offset:counts_offset + 8 * self.number_of_bins] = \
+                np.asarray(counts, dtype='<f8').tobytes() if np is not None else array('d', counts).tobytes()
+            # The stored flag is written with the rest of the header, after the counts
+            self.map[offset:offset + self.record_header.size] = self.record_header.pack(
+                1, first_block, last_block, bytes.fromhex(last_block_hash), tip_height, bytes.fromhex(tip_hash), price)
+
+    def set_price(self, day, price):
+        offset = self.offset(day) + self.record_header.size - 8
+        with self.lock:
+            self.map[offset:offset + 8] = struct.pack('<q', price)
+
+    def invalidate(self, day):
+        offset = self.offset(day)
+        with self.lock:
+            if offset + self.record_size <= len(self.map):
+                self.map[offset:offset + 4] = bytes(4)
+
+    def grow(self, size):
+        """Extend the file to hold at least size bytes, in steps of days_per_growth records."""
+        growth = self.days_per_growth * self.record_size
+        size = self.file_header.size + -(-(size - self.file_header.size) // growth) * growth
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            # Never shrink a file another process has grown further
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.remap()
+
+    def days(self):
+        """The stored days, oldest first."""
+        with self.lock:
+            self.remap()
+            size = len(self.map) if self.map is not None else 0
+            stored_days = []
+            for offset in range(self.file_header.size, size - self.record_size + 1, self.record_size):
+                if struct.unpack_from('<I', self.map, offset)[0]:
+                    index = (offset - self.file_header.size) // self.record_size
+                    stored_days.append(datetime.fromtimestamp((self.first_day_number + index) * 86400, tz=timezone.utc))
+        return stored_days
+
+def get_block_times(heights):
+    """Return the header time of each block height, using two batched round trips."""
+    block_hashes = Ask_Node_Batch([['getblockhash', str(h)] for h in heights])
+    block_headers = Ask_Node_Batch([['getblockheader', h, 'true'] for h in block_hashes])
+    return [json.loads(h)['time'] for h in block_headers]
+
+def search_first_block_of_day(price_day_seconds, latest_time_in_seconds, block_count):
+    """Hunt through block headers on the node for the first block on the target day."""
+    seconds_in_a_day = 60 * 60 * 24
+    seconds_since_price_day = latest_time_in_seconds - price_day_seconds
+    blocks_ago_estimate = round(144 * float(seconds_since_price_day) / float(seconds_in_a_day))
+    price_day_block_estimate = block_count - blocks_ago_estimate
+
+    block_hash_b = Ask_Node(['getblockhash', str(price_day_block_estimate)])
+    block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
+    block_header = json.loads(block_header_b)
+    time_in_seconds = block_header['time']
+
+    seconds_difference = time_in_seconds - price_day_seconds
+    block_jump_estimate = round(144 * float(seconds_difference) / float(seconds_in_a_day))
+
+    last_estimate = 0
+    last_last_estimate = 0
+    while block_jump_estimate > 6 and block_jump_estimate != last_last_estimate:
+        last_last_estimate = last_estimate
+        last_estimate = block_jump_estimate
+        price_day_block_estimate = price_day_block_estimate - block_jump_estimate
         block_hash_b = Ask_Node(['getblockhash', str(price_day_block_estimate)])
         block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
         block_header = json.loads(block_header_b)
         time_in_seconds = block_header['time']
-
         seconds_difference = time_in_seconds - price_day_seconds
         block_jump_estimate = round(144 * float(seconds_difference) / float(seconds_in_a_day))
 
-        last_estimate = 0
-        last_last_estimate = 0
-        while block_jump_estimate > 6 and block_jump_estimate != last_last_estimate:
-            last_last_estimate = last_estimate
-            last_estimate = block_jump_estimate
-            price_day_block_estimate = price_day_block_estimate - block_jump_estimate
-            block_hash_b = Ask_Node(['getblockhash', str(price_day_block_estimate)])
-            block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
-            block_header = json.loads(block_header_b)
-            time_in_seconds = block_header['time']
-            seconds_difference = time_in_seconds - price_day_seconds
-            block_jump_estimate = round(144 * float(seconds_difference) / float(seconds_in_a_day))
-
-        if time_in_seconds > price_day_seconds:
-            while time_in_seconds > price_day_seconds:
-                price_day_block_estimate = price_day_block_estimate - 1
-                block_hash_b = Ask_Node(['getblockhash', str(price_day_block_estimate)])
-                block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
-                block_header = json.loads(block_header_b)
-                time_in_seconds = block_header['time']
-            price_day_block_estimate = price_day_block_estimate + 1
-        elif time_in_seconds < price_day_seconds:
-            while time_in_seconds < price_day_seconds:
-                price_day_block_estimate = price_day_block_estimate + 1
-                block_hash_b = Ask_Node(['getblockhash', str(price_day_block_estimate)])
-                block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
-                block_header = json.loads(block_header_b)
-                time_in_seconds = block_header['time']
-
-        price_day_block = price_day_block_estimate
-
-        ###############################################################################
-        # Part 5) Build the container to hold the output amounts bell curve
-        ###############################################################################
-
-        first_bin_value = -6
-        last_bin_value = 6
-        range_bin_values = last_bin_value - first_bin_value
-
-        output_bell_curve_bins = [0.0]
-        for exponent in range(-6, 6):
-            for b in range(0, 200):
-                bin_value = 10 ** (exponent + b / 200)
-                output_bell_curve_bins.append(bin_value)
-
-        number_of_bins = len(output_bell_curve_bins)
-        output_bell_curve_bin_counts = [0.0] * number_of_bins
-
-        ###############################################################################
-        # Part 6) Get all output amounts from all blocks on target day
-        ###############################################################################
+    # Step block by block, fetching a window of headers per batched round trip
+    if time_in_seconds > price_day_seconds:
+        while time_in_seconds > price_day_seconds:
+            heights = range(price_day_block_estimate - 1,
+                            price_day_block_estimate - 1 - block_hash_batch_size, -1)
+            for price_day_block_estimate, time_in_seconds in zip(heights, get_block_times(heights)):
+                if time_in_seconds <= price_day_seconds:
+                    break
+        price_day_block_estimate = price_day_block_estimate + 1
+    elif time_in_seconds < price_day_seconds:
+        while time_in_seconds < price_day_seconds:
+            heights = range(price_day_block_estimate + 1,
+                            min(price_day_block_estimate + 1 + block_hash_batch_size, block_count + 1))
+            if not heights:
+                raise Exception("Reached the chain tip before the target day started")
+            for price_day_block_estimate, time_in_seconds in zip(heights, get_block_times(heights)):
+                if time_in_seconds >= price_day_seconds:
+                    break
+
+    return price_day_block_estimate
+
+def get_block_hash(height, block_hashes, block_count):
+    """Look up a block hash, fetching the following heights in the same batch."""
+    if height not in block_hashes:
+        heights = range(height, max(height + 1, min(height + block_hash_batch_size, block_count + 1)))
+        block_hashes.update(zip(heights, Ask_Node_Batch([['getblockhash', str(h)] for h in heights])))
+    return block_hashes.pop(height)
+
+def filter_block_transactions(transactions):
+    """Apply the per-transaction Part 6 filters to a block's verbosity-2 transactions.
+
+    Keeps every txid suffix (for the same-day input filter, which depends on the
+    blocks read before this one) and, for each transaction that passes the
+    coinbase/input/output/OP_RETURN/witness filters, its input txid suffixes and
+    output values in satoshis.
+    """
+    txids = array('I')
+    candidates = []
+    for tx_index, tx in enumerate(transactions):
+        txids.append(int(tx['txid'][-8:], 16))
+        inputs = tx['vin']
+        outputs = tx['vout']
+
+        if "coinbase" in inputs[0]:
+            continue
+        if len(inputs) > 5:
+            continue
+        if len(outputs) < 2:
+            continue
+        if len(outputs) > 2:
+            continue
+
+        has_op_return = False
+        for output in outputs:
+            script_pub_key = output.get("scriptPubKey", {})
+            if script_pub_key.get("type") == "nulldata" or "OP_RETURN" in script_pub_key.get("asm", ""):
+                has_op_return = True
+                break
+        if has_op_return:
+            continue
+
+        has_big_witness = False
+        for inpt in inputs:
+            if "txinwitness" in inpt:
+                for witness in inpt["txinwitness"]:
+                    if len(witness) > 500:
+                        has_big_witness = True
+                        break
+            if has_big_witness:
+                break
+        if has_big_witness:
+            continue
+
+        input_txids = tuple(int(inpt['txid'][-8:], 16) for inpt in inputs if 'txid' in inpt)
+        output_values = tuple(round(float(output['value']) * 1e8) for output in outputs)
+        candidates.append((tx_index, input_txids, output_values))
+
+    return txids, candidates
+
+def extract_block_candidates(block):
+    """Filter a decoded verbosity-2 block into its BlockCandidates."""
+    txids, candidates = filter_block_transactions(block['tx'])
+    return BlockCandidates(int(block['time']), txids, candidates)
+
+class StreamedBlock:
+    """Incremental reader of a getblock verbosity-2 reply arriving as byte chunks.
+
+    The block fields before the "tx" array are only searched for the header time;
+    transactions() then decodes and yields one transaction at a time, so at most
+    one transaction (plus a chunk) is held in memory and filtering starts while
+    the rest of the block is still being transferred.
+    """
+
+    tx_array_start = re.compile(r'"tx"\s*:\s*\[')
+    time_field = re.compile(r'"time"\s*:\s*(\d+)')
+    separator = re.compile(r'[\s,]*')
+    decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.time = None
+
+    def read_more(self):
+        """Append the next chunk after the unread part of the buffer, False at the end of the stream."""
+        for chunk in self.chunks:
+            self.buffer = self.buffer[self.position:] + self.text_decoder.decode(chunk)
+            self.position = 0
+            return True
+        return False
 
+    def transactions(self):
+        match = self.tx_array_start.search(self.buffer)
+        while match is None:
+            if not self.read_more():
+                raise Exception(f"getblock reply has no transactions: {self.buffer[:500]}")
+            match = self.tx_array_start.search(self.buffer)
+        self.time = int(self.time_field.search(self.buffer, 0, match.start()).group(1))
+        self.position = match.end()
+
+        while True:
+            self.position = self.separator.match(self.buffer, self.position).end()
+            while self.position == len(self.buffer):
+                if not self.read_more():
+                    raise Exception("getblock reply ended inside the transaction array")
+                self.position = self.separator.match(self.buffer, self.position).end()
+            if self.buffer[self.position] == ']':
+                break
+
+            # Retry decoding only once the buffer has doubled, so a large
+            # transaction split over many chunks is not re-parsed for each one
+            retry_length = 0
+            stream_ended = False
+            while True:
+                if len(self.buffer) >= retry_length or stream_ended:
+                    try:
+                        tx, self.position = self.decoder.raw_decode(self.buffer, self.position)
+                        break
+                    except json.JSONDecodeError:
+                        if stream_ended:
+                            raise Exception("getblock reply ended inside a transaction")
+                        retry_length = 2 * (len(self.buffer) - self.position)
+                stream_ended = not self.read_more()
+            yield tx
+
+        # Drain the rest of the reply so the channel or connection finishes cleanly
+        while self.read_more():
+            self.position = len(self.buffer)
+
+def extract_streamed_block_candidates(chunks):
+    """Same as extract_block_candidates, filtering each transaction as it is received."""
+    block = StreamedBlock(chunks)
+    txids, candidates = filter_block_transactions(block.transactions())
+    return BlockCandidates(block.time, txids, candidates)
+
+def build_bell_curve_bins(bins_per_decade=200):
+    """Lower edges of the output amount bins: 0, then log-spaced bins (200 per decade by default) from 1e-6 to 1e6 BTC."""
+    output_bell_curve_bins = [0.0]
+    for exponent in range(-6, 6):
+        for b in range(0, bins_per_decade):
+            bin_value = 10 ** (exponent + b / bins_per_decade)
+            output_bell_curve_bins.append(bin_value)
+    return output_bell_curve_bins
+
+def empty_bell_curve(number_of_bins):
+    """Zeroed, array-backed bin counts for the output amounts bell curve."""
+    if np is not None:
+        return np.zeros(number_of_bins)
+    return array('d', bytes(8 * number_of_bins))
+
+def bin_output_values(output_values, bin_edges, output_bell_curve_bin_counts):
+    """Count output values (in sats) between 1e-5 and 1e5 BTC into their bins, in one call.
+
+    An amount falls in the last bin whose lower edge is <= amount, which is what a
+    right-sided searchsorted (or bisect_right) minus one returns.
+    """
+    if np is not None:
+        amounts = np.asarray(output_values, dtype=np.int64) / 1e8
+        amounts = amounts[(amounts > 1e-5) & (amounts < 1e5)]
+        bin_numbers = np.searchsorted(bin_edges, amounts, side='right') - 1
+        output_bell_curve_bin_counts += np.bincount(bin_numbers, minlength=len(output_bell_curve_bin_counts))
+    else:
+        for value in output_values:
+            amount = value / 1e8
+            if 1e-5 < amount < 1e5:
+                output_bell_curve_bin_counts[bisect_right(bin_edges, amount) - 1] += 1.0
+
+class TxidFilter:
+    """Set of integer txid keys for the same-day input filter, kept in flat numpy arrays.
+
+    Keys are stored plus one as 64-bit integers in an open-addressing table (linear
+    probing, at most half full), 16 to 32 bytes per key against some 60 in a set of
+    ints. A slot holding 0 is free, so clear() zeroes the table and it is reused for
+    the next day. With bloom=True, lookups first test three bits per key in a Bloom
+    filter of 8 bits per slot and only probe the table for keys that may be present.
+    """
+
+    hash_multiplier = np.uint64(0x9E3779B97F4A7C15) if np is not None else None
+    bloom_multipliers = ([np.uint64(m) for m in (0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93)]
+                         if np is not None else None)
+
+    def __init__(self, capacity_log2=20, bloom=False):
+        self.capacity_log2 = capacity_log2
+        self.keys = np.zeros(1 << capacity_log2, dtype=np.uint64)
+        self.size = 0
+        self.bloom_bits = np.zeros(1 << capacity_log2, dtype=np.uint8) if bloom else None
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return bool(self.contains_many(np.array([key], dtype=np.uint64))[0])
+
+    def update(self, keys):
+        self.add_many(np.unique(np.asarray(keys, dtype=np.uint64)))
+
+    def clear(self):
+        self.size = 0
+        self.keys.fill(0)
+        if self.bloom_bits is not None:
+            self.bloom_bits.fill(0)
+
+    def slots(self, stored_keys):
+        with np.errstate(over='ignore'):
+            return (stored_keys * self.hash_multiplier) >> np.uint64(64 - self.capacity_log2)
+
+    def bloom_positions(self, keys):
+        shift = np.uint64(64 - self.capacity_log2 - 3)
+        with np.errstate(over='ignore'):
+            return [(keys * multiplier) >> shift for multiplier in self.bloom_multipliers]
+
+    def add_many(self, keys):
+        """Add an array of distinct keys."""
+        if (self.size + len(keys)) * 2 > len(self.keys):
+            self.grow(self.size + len(keys))
+        if self.bloom_bits is not None:
+            for positions in self.bloom_positions(keys):
+                np.bitwise_or.at(self.bloom_bits, positions >> np.uint64(3),
+                                 np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        stored_keys = keys + np.uint64(1)
+        mask = np.uint64(len(self.keys) - 1)
+        slots = self.slots(stored_keys)
+        while len(stored_keys):
+            # Keys landing on the same free slot all write it and one of them ends up
+            # there; the others find it taken by another key and probe on
+            free = self.keys[slots] == 0
+            self.keys[slots[free]] = stored_keys[free]
+            stored = self.keys[slots] == stored_keys
+            self.size += int(np.count_nonzero(stored & free))
+            stored_keys = stored_keys[~stored]
+            slots = (slots[~stored] + np.uint64(1)) & mask
+
+    def contains_many(self, keys):
+        """Boolean array telling which of keys are in the filter."""
+        found = np.zeros(len(keys), dtype=np.bool_)
+        if self.bloom_bits is not None:
+            maybe = np.ones(len(keys), dtype=np.bool_)
+            for positions in self.bloom_positions(keys):
+                maybe &= (self.bloom_bits[positions >> np.uint64(3)] >> (positions & np.uint64(7))) & 1 == 1
+            candidates = np.flatnonzero(maybe)
+        else:
+            candidates = np.arange(len(keys))
+        stored_keys = keys[candidates] + np.uint64(1)
+        mask = np.uint64(len(self.keys) - 1)
+        slots = self.slots(stored_keys)
+        while len(candidates):
+            slot_keys = self.keys[slots]
+            hit = slot_keys == stored_keys
+            found[candidates[hit]] = True
+            probe_on = (slot_keys != 0) & ~hit
+            candidates, stored_keys = candidates[probe_on], stored_keys[probe_on]
+            slots = (slots[probe_on] + np.uint64(1)) & mask
+        return found
+
+    def grow(self, needed):
+        """Move to a table at least twice needed, keeping the keys added since clear()."""
+        keys = self.keys[self.keys != 0] - np.uint64(1)
+        while 2 * needed > (1 << self.capacity_log2):
+            self.capacity_log2 += 1
+        bloom = self.bloom_bits is not None
+        self.__init__(self.capacity_log2, bloom)
+        self.add_many(keys)
+
+    def candidate_output_values(self, block):
+        """The output values of a block's candidates without same-day inputs (an
+        int64 array), adding the block's txids to the filter.
+
+        Inputs are matched against the txids of earlier blocks in the table, and
+        against this block's txids up to and including the candidate's own.
+        """
+        block_txids = np.frombuffer(block.txids, dtype=np.uint32).astype(np.uint64)
+        distinct_txids, first_positions = np.unique(block_txids, return_index=True)
+        output_values = np.zeros(0, dtype=np.int64)
+        if len(block.tx_indexes):
+            input_counts = np.frombuffer(block.input_counts, dtype=np.uint8)
+            input_txids = np.frombuffer(block.input_txids, dtype=np.uint32).astype(np.uint64)
+
+            sameday = self.contains_many(input_txids)
+            found_at = np.minimum(np.searchsorted(distinct_txids, input_txids), len(distinct_txids) - 1)
+            owner_tx_indexes = np.repeat(np.frombuffer(block.tx_indexes, dtype=np.uint32), input_counts)
+            sameday |= (distinct_txids[found_at] == input_txids) & (first_positions[found_at] <= owner_tx_indexes)
+
+            owners = np.repeat(np.arange(len(block.tx_indexes)), input_counts)
+            keep = np.bincount(owners[sameday], minlength=len(block.tx_indexes)) == 0
+            output_values = np.frombuffer(block.output_values, dtype=np.int64)[
+                np.repeat(keep, np.frombuffer(block.output_counts, dtype=np.uint8))]
+        self.add_many(distinct_txids)
+        return output_values
+
+# Reused between days by estimate_price (see same_day_txid_filter)
+txid_filter = None
+
+def same_day_txid_filter(bloom=False):
+    """An empty same-day txid filter: the cleared TxidFilter with numpy, else a set."""
+    global txid_filter
+    if np is None:
+        return set()
+    if txid_filter is None or (txid_filter.bloom_bits is not None) != bloom:
+        txid_filter = TxidFilter(bloom=bloom)
+    else:
+        txid_filter.clear()
+    return txid_filter
+
+def bin_block_outputs(block, todays_txids, bin_edges, output_bell_curve_bin_counts):
+    """Add one block's candidate outputs to the bell curve, skipping same-day inputs."""
+    if isinstance(todays_txids, TxidFilter):
+        bin_output_values(todays_txids.candidate_output_values(block), bin_edges, output_bell_curve_bin_counts)
+        return
+
+    # Replay the block's txids in order so a candidate only sees same-day
+    # transactions that came before it (and itself), as when reading the block
+    output_values = []
+    position = inputs = outputs = 0
+    block_txids = block.txids.tolist()
+    all_input_txids, all_values = block.input_txids.tolist(), block.output_values.tolist()
+    for tx_index, input_count, output_count in zip(block.tx_indexes, block.input_counts, block.output_counts):
+        todays_txids.update(block_txids[position:tx_index + 1])
+        position = tx_index + 1
+        input_txids = all_input_txids[inputs:inputs + input_count]
+        candidate_values = all_values[outputs:outputs + output_count]
+        inputs += input_count
+        outputs += output_count
+
+        has_sameday_input = False
+        for input_txid in input_txids:
+            if input_txid in todays_txids:
+                has_sameday_input = True
+                break
+        if has_sameday_input:
+            continue
+
+        output_values.extend(candidate_values)
+
+    todays_txids.update(block_txids[position:])
+    bin_output_values(output_values, bin_edges, output_bell_curve_bin_counts)
+
+def read_varint(data, offset):
+    """Decode a CompactSize integer, returning (value, next offset)."""
+    first = data[offset]
+    if first < 0xfd:
+        return first, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[first]
+    return int.from_bytes(data[offset + 1:offset + 1 + size], 'little'), offset + 1 + size
+
+def script_has_op_return(script):
+    """True if OP_RETURN is one of the script's opcodes, i.e. it shows up in the script's asm."""
+    position = 0
+    while position < len(script):
+        opcode = script[position]
+        position += 1
+        if opcode == 0x6a:
+            return True
+        if opcode <= 0x4b:
+            position += opcode
+        elif opcode == 0x4c:
+            position += 1 + (script[position] if position < len(script) else 0)
+        elif opcode == 0x4d:
+            position += 2 + int.from_bytes(script[position:position + 2], 'little')
+        elif opcode == 0x4e:
+            position += 4 + int.from_bytes(script[position:position + 4], 'little')
+    return False
+
+null_prevout = b'\x00' * 32 + b'\xff' * 4
+
+def extract_raw_block_candidates(raw_block):
+    """Same as extract_block_candidates, but parsing a serialized (verbosity 0) block.
+
+    Txids are the double-SHA256 of each transaction without its witness data, and
+    a witness item longer than 250 bytes is the 500 hex digits of the JSON filter.
+    """
+    data = memoryview(raw_block)
+    block_time = int.from_bytes(data[68:72], 'little')
+    tx_count, offset = read_varint(data, 80)
+
+    block = BlockCandidates(block_time, array('I'))
+    for tx_index in range(tx_count):
+        version_start = offset
+        offset += 4
+        has_witness = data[offset] == 0 and data[offset + 1] != 0
+        if has_witness:
+            offset += 2
+        body_start = offset
+
+        input_count, offset = read_varint(data, offset)
+        is_coinbase = input_count == 1 and data[offset:offset + 36] == null_prevout
+        input_txids = []
+        for _ in range(input_count):
+            input_txids.append(int.from_bytes(data[offset:offset + 4], 'little'))
+            script_length, offset = read_varint(data, offset + 36)
+            offset += script_length + 4
+
+        output_count, offset = read_varint(data, offset)
+        output_values = []
+        output_scripts = []
+        for _ in range(output_count):
+            output_values.append(int.from_bytes(data[offset:offset + 8], 'little', signed=True))
+            script_length, offset = read_varint(data, offset + 8)
+            output_scripts.append((offset, offset + script_length))
+            offset += script_length
+        body_end = offset
+
+        has_big_witness = False
+        if has_witness:
+            for _ in range(input_count):
+                item_count, offset = read_varint(data, offset)
+                for _ in range(item_count):
+                    item_length, offset = read_varint(data, offset)
+                    if item_length > 250:
+                        has_big_witness = True
+                    offset += item_length
+
+        tx_hash = hashlib.sha256(data[version_start:version_start + 4])
+        tx_hash.update(data[body_start:body_end])
+        tx_hash.update(data[offset:offset + 4])
+        offset += 4
+        txid = hashlib.sha256(tx_hash.digest()).digest()
+        block.txids.append(int.from_bytes(txid[:4], 'little'))
+
+        if is_coinbase or input_count > 5 or output_count != 2 or has_big_witness:
+            continue
+        if any(script_has_op_return(data[start:end]) for start, end in output_scripts):
+            continue
+        block.add_candidate(tx_index, input_txids, output_values)
+
+    return block
+
+# Entry point of the node-side agent; the rest of its source is copied from this file
+agent_main = """
+def main():
+    # One length-prefixed BlockCandidates record per block hash argument
+    for block_hash in sys.argv[1:]:
+        raw_hex = subprocess.run(node_command + ['getblock', block_hash, '0'],
+                                 stdout=subprocess.PIPE, check=True).stdout
+        record = extract_raw_block_candidates(bytes.fromhex(raw_hex.decode().strip())).to_bytes()
+        sys.stdout.buffer.write(struct.pack('<I', len(record)) + record)
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
+"""
+
+# Path of the uploaded agent on the node (see initialize_agent)
+agent_path = None
+
+def agent_source():
+    """Source of the node-side agent: the raw block parser and BlockCandidates from this
+    file, run next to bitcoind so only the filtered candidates cross the SSH link."""
+    parts = ['"""sshUTXOracle node-side agent: prints the Part 6 candidates of the blocks given."""',
+             'import sys\nimport struct\nimport hashlib\nimport subprocess\nfrom array import array',
+             f'node_command = {shlex.split(build_podman_command([]))!r}',
+             f'null_prevout = {null_prevout!r}']
+    parts += [inspect.getsource(f) for f in (read_varint, script_has_op_return, BlockCandidates,
+                                             extract_raw_block_candidates)]
+    parts.append(agent_main)
+    return '\n\n'.join(parts)
+
+def upload_agent(client, source):
+    """Upload the agent source over an SSH connection unless already there, and check it
+    runs, returning its path on the node.
+
+    The agent goes to ~/.cache/utxoracle, a directory only the SSH user can enter, and
+    a file already there is only reused if it holds the same source.
+    """
+    sftp = client.open_sftp()
+    try:
+        cache_directory = sftp.normalize('.') + '/.cache'
+        directory = cache_directory + '/utxoracle'
+        for new_directory in (cache_directory, directory):
+            try:
+                sftp.mkdir(new_directory, 0o700)
+            except IOError:
+                pass  # already there
+        sftp.chmod(directory, 0o700)
+        path = f"{directory}/agent-{hashlib.sha1(source).hexdigest()[:12]}.py"
+        try:
+            with sftp.open(path, 'rb') as f:
+                uploaded = f.read()
+        except IOError:
+            uploaded = None
+        if uploaded != source:
+            if uploaded is not None:
+                sftp.remove(path)  # not the agent this source would upload
+            # Upload under a temporary name so other processes never run a partial file
+            temporary_path = f"{path}.{os.getpid()}"
+            sftp.putfo(io.BytesIO(source), temporary_path)
+            try:
+                sftp.rename(temporary_path, path)
+            except IOError:
+                sftp.remove(temporary_path)  # uploaded meanwhile by another process
+    finally:
+        sftp.close()
+    stdin, stdout, stderr = client.exec_command(f"python3 {shlex.quote(path)}")
+    error = stderr.read().decode().strip()
+    if stdout.channel.recv_exit_status() != 0:
+        raise Exception(error or "python3 failed without specific error")
+    return path
+
+def initialize_agent(args):
+    """Upload the agent over SFTP to every host for --block-format agent, falling back to
+    raw blocks if it cannot be uploaded or run on one of them."""
+    global agent_path
+    if replay_node is not None or ssh is None:
+        print("The node-side agent needs an SSH connection, using raw blocks")
+        args.block_format = 'raw'
+        return
+    source = agent_source().encode()
+    try:
+        path = upload_agent(ssh, source)
+        for node in fanout_nodes:
+            node.agent_path = upload_agent(node.ssh, source)
+    except Exception as e:
+        print(f"Node-side agent unavailable ({str(e)}), using raw blocks")
+        args.block_format = 'raw'
+        return
+    agent_path = path
+    print(f"Node-side agent uploaded to {path}")
+
+def Ask_Node_Agent(block_hashes):
+    """Run the node-side agent on some block hashes, returning their BlockCandidates."""
+    client, _, path = node_connection()
+    if client is None or path is None:
+        raise Exception("Node-side agent not initialized")
+    hashes = [h.decode('utf-8') if isinstance(h, bytes) else str(h) for h in block_hashes]
+    transport = 'agent@' + node_host() if fanout_nodes else 'agent'
+    started = time.perf_counter()
+    output = b''
+    try:
+        stdin, stdout, stderr = client.exec_command(' '.join(['python3', shlex.quote(path)] + hashes))
+        output = stdout.read()
+        error = stderr.read().decode().strip()
+        if stdout.channel.recv_exit_status() != 0:
+            raise Exception(f"agent error: {error or 'Command failed without specific error'}")
+    except Exception:
+        stats.observe_node_call(transport, ['getblock'], time.perf_counter() - started, len(output), len(hashes), True)
+        raise
+    stats.observe_node_call(transport, ['getblock'], time.perf_counter() - started, len(output), len(hashes))
+
+    blocks = []
+    offset = 0
+    while offset < len(output):
+        length, = struct.unpack_from('<I', output, offset)
+        blocks.append(BlockCandidates.from_bytes(output[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+    if len(blocks) != len(hashes):
+        raise Exception(f"agent error: {len(blocks)} blocks returned for {len(hashes)} hashes")
+    return blocks
+
+def fetch_block_candidates(block_hash_b, block_cache=None, block_format='raw'):
+    """Fetch one block's candidates from the cache or the node (runs on a prefetch worker)."""
+    block_hash = block_hash_b.decode()
+    if block_format == 'cross-check':
+        block = extract_raw_block_candidates(bytes.fromhex(Ask_Node(['getblock', block_hash_b, '0']).decode()))
+        block.cross_check = extract_block_candidates(json.loads(Ask_Node(['getblock', block_hash_b, '2'])))
+        if (block.time, block.txids, block.candidates) != \
+                (block.cross_check.time, block.cross_check.txids, block.cross_check.candidates):
+            print(f"Cross-check: raw and json candidates differ in block {block_hash}")
+        return block
+    if block_cache is not None:
+        started = time.perf_counter()
+        block = block_cache.get(block_hash)
+        if block is not None:
+            stats.observe_phase('block_cache_read', time.perf_counter() - started)
+            return block
+    if block_format == 'raw':
+        answer = Ask_Node(['getblock', block_hash_b, '0'])
+        started = time.perf_counter()
+        block = extract_raw_block_candidates(bytes.fromhex(answer.decode()))
+        stats.observe_phase('block_parse_raw', time.perf_counter() - started)
+    elif block_format == 'agent':
+        block, = Ask_Node_Agent([block_hash_b])
+    elif block_format == 'json-stream':
+        # Decoding overlaps the transfer, so this includes the time waiting for chunks
+        started = time.perf_counter()
+        block = extract_streamed_block_candidates(Ask_Node_Stream(['getblock', block_hash_b, '2']))
+        stats.observe_phase('block_fetch_parse_json_stream', time.perf_counter() - started)
+    else:
+        answer = Ask_Node(['getblock', block_hash_b, '2'])
+        started = time.perf_counter()
+        block = extract_block_candidates(json.loads(answer))
+        stats.observe_phase('block_parse_json', time.perf_counter() - started)
+    if block_cache is not None:
+        block_cache.put(block_hash, block)
+    return block
+
+def fetch_blocks(first_height, last_height, fetch_threads, prefetch_depth, header_index=None, block_cache=None,
+                 block_format='raw'):
+    """Yield (height, BlockCandidates) in height order from first_height up to last_height.
+
+    Up to prefetch_depth blocks are requested ahead of the consumer, spread over
+    fetch_threads concurrent SSH channels, so fetching and decoding the next blocks
+    overlaps with the caller processing the current one. With several --ip hosts the
+    fetches fan out over them (see fetch_blocks_fanout).
+    """
+    if fanout_nodes:
+        yield from fetch_blocks_fanout(first_height, last_height, fetch_threads, prefetch_depth, header_index,
+                                       block_cache, block_format)
+        return
+    executor = ThreadPoolExecutor(max_workers=max(1, fetch_threads))
+    pending = deque()
+    block_hashes = {}
+    next_height = first_height
+    try:
+        while True:
+            while next_height <= last_height and len(pending) < max(1, prefetch_depth):
+                if header_index is not None:
+                    block_hash_b = header_index.hash_at(next_height).encode()
+                else:
+                    block_hash_b = get_block_hash(next_height, block_hashes, last_height)
+                pending.append((next_height, executor.submit(fetch_block_candidates, block_hash_b, block_cache, block_format)))
+                next_height += 1
+            if not pending:
+                return
+            height, future = pending.popleft()
+            yield height, future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Seconds the further hosts get to answer the block hash check before a fetch
+fanout_check_timeout = 10.0
+
+def agreeing_fanout_nodes(last_height, reference_hash):
+    """The further hosts whose block at last_height is reference_hash, the first host's.
+
+    A block hash commits to every block before it, so these hosts agree on the whole range.
+    The hosts are asked at the same time, and those that have not answered within
+    fanout_check_timeout seconds are left out.
+    """
+    answers = {}
+
+    def ask(node):
+        bind_node(node)
+        try:
+            answers[node] = Ask_Node(['getblockhash', str(last_height)]).decode()
+        except Exception as e:
+            answers[node] = f"unavailable ({str(e)})"
+
+    # Daemon threads, so a hung host holds up neither the fetch nor the exit
+    threads = [threading.Thread(target=ask, args=(node,), daemon=True) for node in fanout_nodes]
+    for thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + fanout_check_timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.perf_counter()))
+
+    agreeing = []
+    for node, thread in zip(fanout_nodes, threads):
+        # A hung host may still answer later, so only finished threads are read
+        if thread.is_alive():
+            print(f"Leaving {node.ip} out of the fetch: no block hash within {fanout_check_timeout:g} seconds")
+        elif answers[node] == reference_hash:
+            agreeing.append(node)
+        else:
+            print(f"Leaving {node.ip} out of the fetch: its block {last_height} is {answers[node]}, "
+                  f"not {reference_hash}")
+    return agreeing
+
+def fetch_blocks_fanout(first_height, last_height, fetch_threads, prefetch_depth, header_index=None,
+                        block_cache=None, block_format='raw'):
+    """fetch_blocks over the first host and the further hosts agreeing with it on the range.
+
+    Blocks wait in one queue in height order, and each host's fetch_threads threads take
+    the next one whenever they are free, so faster hosts fetch more of them. A host whose
+    fetch fails, or that is slow on the block the caller waits for, gets no more blocks
+    in this range, and its block goes back to the front of the queue for the others.
+    Blocks are fetched by hash, so the result does not depend on which host answered.
+    """
+    block_hashes = {}
+
+    def hash_at(height):
+        if header_index is not None:
+            return header_index.hash_at(height).encode()
+        return get_block_hash(height, block_hashes, last_height)
+
+    def host_name(node):
+        return ssh_host if node is None else node.ip
+
+    nodes = [None] + agreeing_fanout_nodes(last_height, hash_at(last_height).decode())
+    active = set(nodes)
+    work = deque()  # (height, block_hash_b, hosts that failed or were slow on it)
+    attempts = {}  # height -> (started, node, queue item) of the fetch under way
+    waiting = set()  # heights queued and not yet passed on
+    results = {}
+    durations = deque(maxlen=64)
+    errors = []
+    finished = False
+    condition = threading.Condition()
+
+    def take(node):
+        """The first queued block node may fetch, unless every active host is excluded from it."""
+        for position, item in enumerate(work):
+            if node not in item[2] or active <= item[2]:
+                del work[position]
+                return item
+        return None
+
+    def fetch_worker(node):
+        bind_node(node)
+        while True:
+            with condition:
+                item = None
+                while item is None and not finished and node in active:
+                    item = take(node)
+                    if item is None:
+                        condition.wait()
+                if item is None:
+                    return
+                height, block_hash_b, excluded = item
+                started = time.perf_counter()
+                attempts[height] = (started, node, item)
+            try:
+                block = fetch_block_candidates(block_hash_b, block_cache, block_format)
+            except Exception as e:
+                with condition:
+                    if node in active:
+                        active.discard(node)
+                        print(f"Block fetch from {host_name(node)} failed ({str(e)}), "
+                              f"moving its blocks to the other hosts")
+                    if height in waiting and height not in results and \
+                            attempts.get(height, (None, None, None))[1] is node:
+                        del attempts[height]
+                        work.appendleft((height, block_hash_b, excluded | {node}))
+                    if not active:
+                        errors.append(e)
+                    condition.notify_all()
+                return
+            with condition:
+                durations.append(time.perf_counter() - started)
+                if height in waiting:
+                    results.setdefault(height, block)  # dropped if already passed on
+                if attempts.get(height, (None, None, None))[1] is node:
+                    del attempts[height]
+                condition.notify_all()
+
+    def requeue_if_slow(height):
+        """Move the block the caller waits for to another host if its fetch is overdue."""
+        if height not in attempts:
+            return
+        started, node, (_, block_hash_b, excluded) = attempts[height]
+        threshold = slow_fetch_seconds
+        if durations:
+            threshold = max(threshold, slow_fetch_factor * sorted(durations)[len(durations) // 2])
+        if time.perf_counter() - started < threshold or not active - {node}:
+            return
+        if node in active:
+            active.discard(node)
+            print(f"{host_name(node)} is slow on block {height}, moving its blocks to the other hosts")
+        del attempts[height]
+        work.appendleft((height, block_hash_b, excluded | {node}))
+        condition.notify_all()
+
+    threads = [threading.Thread(target=fetch_worker, args=(node,), daemon=True)
+               for node in nodes for _ in range(max(1, fetch_threads))]
+    for thread in threads:
+        thread.start()
+    # Keep every host's threads busy, however small --prefetch is
+    window = max(prefetch_depth, len(threads))
+    next_height = first_height
+    try:
+        for height in range(first_height, last_height + 1):
+            while next_height <= last_height and next_height < height + window:
+                block_hash_b = hash_at(next_height)
+                with condition:
+                    work.append((next_height, block_hash_b, frozenset()))
+                    waiting.add(next_height)
+                    condition.notify()
+                next_height += 1
+            with condition:
+                while height not in results:
+                    if errors:
+                        raise Exception(f"Every host failed fetching block {height}: {str(errors[0])}")
+                    requeue_if_slow(height)
+                    condition.wait(timeout=0.5)
+                block = results.pop(height)
+                waiting.discard(height)
+            yield height, block
+    finally:
+        with condition:
+            finished = True
+            condition.notify_all()
+
+# Bin edges of the output amounts bell curve (Part 5), built once for the current
+# resolution (see set_bins_per_decade), and whether the fit interpolates between bins
+bins_per_decade = 200
+sub_bin_interpolation = False
+output_bell_curve_bins = build_bell_curve_bins()
+bell_curve_bin_edges = np.array(output_bell_curve_bins) if np is not None else output_bell_curve_bins
+
+# Local header index, block cache and day store (see initialize_caches)
+header_index = None
+block_cache = None
+day_store = None
+
+def initialize_caches(args):
+    """Open the header index, block cache and day store under --cache-dir, unless disabled."""
+    global header_index, block_cache, day_store
+    cache_dir = os.path.expanduser(args.cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    if not args.no_header_index:
+        header_index = HeaderIndex(os.path.join(cache_dir, 'headers.dat'), header_index_start_height)
+    if args.block_cache_mb > 0:
+        block_cache = BlockCache(os.path.join(cache_dir, 'blocks'), args.block_cache_mb * 1024 * 1024)
+    if not args.no_day_store:
+        # Bell curves of different resolutions are stored apart
+        day_store_file = 'days.dat' if bins_per_decade == 200 else f'days-{bins_per_decade}.dat'
+        day_store = DayStore(os.path.join(cache_dir, day_store_file), len(output_bell_curve_bins))
+
+def get_latest_block():
+    """Return the block count, the tip's header time, and the UTC midnight starting the tip's day."""
+    started = time.perf_counter()
+    block_count_b = Ask_Node(['getblockcount'])
+    block_count = int(block_count_b)
+
+    if header_index is not None:
+        header_index.update(block_count)
+        latest_time_in_seconds = header_index.time_at(block_count)
+    else:
+        block_hash_b = Ask_Node(['getblockhash', str(block_count)])
+        block_header_b = Ask_Node(['getblockheader', block_hash_b, 'true'])
+        block_header = json.loads(block_header_b)
+        latest_time_in_seconds = block_header['time']
+
+    time_datetime = datetime.fromtimestamp(latest_time_in_seconds, tz=timezone.utc)
+
+    latest_year = int(time_datetime.strftime("%Y"))
+    latest_month = int(time_datetime.strftime("%m"))
+    latest_day = int(time_datetime.strftime("%d"))
+    latest_utc_midnight = datetime(latest_year, latest_month, latest_day, 0, 0, 0, tzinfo=timezone.utc)
+    stats.observe_phase('part2_latest_block', time.perf_counter() - started)
+    return block_count, latest_time_in_seconds, latest_utc_midnight
+
+def estimate_price(datetime_entered, block_count, latest_time_in_seconds, args, verbose=True):
+    """Run Parts 4-9 for the UTC day starting at datetime_entered.
+
+    Returns a dict with the date, the price estimate, the block range read, and the
+    best and second best stencil slides with their scores.
+    """
+    seconds_in_a_day = 60 * 60 * 24
+    price_day_seconds = int(datetime_entered.timestamp())
+    price_day_date_utc = datetime_entered.strftime("%B %d, %Y")
+
+    # A finished day already in the day store only needs Parts 7-9 rerun
+    stored = stored_day(datetime_entered)
+    if stored is not None:
+        if verbose:
+            print(f"\nUsing the stored bell curve of blocks {stored['first_block']}-{stored['last_block']}")
+        started = time.perf_counter()
+        fit = fit_bell_curve(stored['counts'])
+        stats.observe_phase('part7_9_fit', time.perf_counter() - started)
+        if fit['price'] != stored['price']:
+            day_store.set_price(datetime_entered, fit['price'])
+        return price_result(datetime_entered, fit, stored['first_block'], stored['last_block'])
+
+    ###############################################################################
+    # Part 4) Hunt through blocks to find the first block on the target day
+    ###############################################################################
+
+    started = time.perf_counter()
+    if header_index is not None:
+        price_day_block = header_index.first_height_at_or_after(price_day_seconds)
+        price_day_last_block = header_index.first_height_at_or_after(price_day_seconds + seconds_in_a_day) - 1
+    else:
+        price_day_block = search_first_block_of_day(price_day_seconds, latest_time_in_seconds, block_count)
+        price_day_last_block = None
+    stats.observe_phase('part4_find_first_block', time.perf_counter() - started)
+
+    ###############################################################################
+    # Part 5) Build the container to hold the output amounts bell curve
+    ###############################################################################
+
+    # The bin edges are built once at startup by build_bell_curve_bins()
+    number_of_bins = len(output_bell_curve_bins)
+    output_bell_curve_bin_counts = empty_bell_curve(number_of_bins)
+
+    ###############################################################################
+    # Part 6) Get all output amounts from all blocks on target day
+    ###############################################################################
+
+    if verbose:
         print("\nReading all blocks on " + price_day_date_utc + "...")
         print("This will take a few minutes (~144 blocks)...")
         print("\nBlock Height\t Block Time(utc)\t\tCompletion %")
 
-        block_height = price_day_block
-        block_hash_b = Ask_Node(['getblockhash', str(block_height)])
-        block_b = Ask_Node(['getblock', block_hash_b, '2'])
-        block = json.loads(block_b)
+    started = time.perf_counter()
+    todays_txids = same_day_txid_filter(args.txid_bloom)
+    target_day_of_month = None
 
-        time_in_seconds = int(block['time'])
+    cross_check_counts = None
+    if args.block_format == 'cross-check':
+        cross_check_txids = set()
+        cross_check_counts = empty_bell_curve(number_of_bins)
+
+    blocks = fetch_blocks(price_day_block, price_day_last_block or block_count,
+                          args.fetch_threads, args.prefetch, header_index, block_cache, args.block_format)
+    for block_height, block in blocks:
+
+        time_in_seconds = block.time
         time_datetime = datetime.fromtimestamp(time_in_seconds, tz=timezone.utc)
         time_utc = time_datetime.strftime(" %Y-%m-%d %H:%M:%S")
-        hour_of_day = int(time_datetime.strftime("%H"))
-        minute_of_hour = float(time_datetime.strftime("%M"))
         day_of_month = int(time_datetime.strftime("%d"))
-        target_day_of_month = day_of_month
+        minute_of_hour = float(time_datetime.strftime("%M"))
+        hour_of_day = int(time_datetime.strftime("%H"))
 
-        todays_txids = set()
+        # Without the header index the day's end is found by reading one block past it
+        if target_day_of_month is None:
+            target_day_of_month = day_of_month
+        elif price_day_last_block is None and target_day_of_month != day_of_month:
+            break
 
-        while target_day_of_month == day_of_month:
+        if verbose:
             progress_estimate = 100.0 * (hour_of_day + minute_of_hour / 60) / 24.0
             print(str(block_height) + "\t\t" + time_utc + "\t\t" + f"{progress_estimate:.2f}" + "%")
+        price_day_last_block_read = block_height
 
-            for tx in block['tx']:
-                todays_txids.add(tx['txid'][-8:])
-                inputs = tx['vin']
-                outputs = tx['vout']
+        bin_started = time.perf_counter()
+        bin_block_outputs(block, todays_txids, bell_curve_bin_edges, output_bell_curve_bin_counts)
+        stats.observe_phase('block_filter_bin', time.perf_counter() - bin_started)
 
-                if "coinbase" in inputs[0]:
-                    continue
-                if len(inputs) > 5:
-                    continue
-                if len(outputs) < 2:
-                    continue
-                if len(outputs) > 2:
-                    continue
-
-                has_op_return = False
-                for output in outputs:
-                    script_pub_key = output.get("scriptPubKey", {})
-                    if script_pub_key.get("type") == "nulldata" or "OP_RETURN" in script_pub_key.get("asm", ""):
-                        has_op_return = True
-                        break
-                if has_op_return:
-                    continue
-
-                has_sameday_input = False
-                has_big_witness = False
-                for inpt in inputs:
-                    if 'txid' in inpt and inpt['txid'][-8:] in todays_txids:
-                        has_sameday_input = True
-                        break
-                    if "txinwitness" in inpt:
-                        for witness in inpt["txinwitness"]:
-                            if len(witness) > 500:
-                                has_big_witness = True
-                                break
-                    if has_sameday_input or has_big_witness:
-                        break
+        if cross_check_counts is not None:
+            bin_block_outputs(block.cross_check, cross_check_txids, bell_curve_bin_edges, cross_check_counts)
 
-                if has_sameday_input or has_big_witness:
-                    continue
-
-                for output in outputs:
-                    amount = float(output['value'])
-                    if 1e-5 < amount < 1e5:
-                        amount_log = log10(amount)
-                        percent_in_range = (amount_log - first_bin_value) / range_bin_values
-                        bin_number_est = int(percent_in_range * number_of_bins)
-                        while output_bell_curve_bins[bin_number_est] <= amount:
-                            bin_number_est += 1
-                        bin_number = bin_number_est - 1
-                        output_bell_curve_bin_counts[bin_number] += 1.0
-
-            block_height = block_height + 1
-            block_hash_b = Ask_Node(['getblockhash', str(block_height)])
-            block_b = Ask_Node(['getblock', block_hash_b, '2'])
-            block = json.loads(block_b)
-
-            time_in_seconds = int(block['time'])
-            time_datetime = datetime.fromtimestamp(time_in_seconds, tz=timezone.utc)
-            time_utc = time_datetime.strftime(" %Y-%m-%d %H:%M:%S")
-            day_of_month = int(time_datetime.strftime("%d"))
-            minute_of_hour = float(time_datetime.strftime("%M"))
-            hour_of_day = int(time_datetime.strftime("%H"))
-
-        ###############################################################################
-        # Part 7) Remove non-usd related outputs from the bell curve
-        ###############################################################################
-
-        for n in range(0, 201):
-            output_bell_curve_bin_counts[n] = 0
-        for n in range(1601, len(output_bell_curve_bin_counts)):
-            output_bell_curve_bin_counts[n] = 0
-
-        round_btc_bins = [
-            201, 401, 461, 496, 540, 601, 661, 696, 740, 801, 861, 896, 940, 1001, 1061, 1096, 1140, 1201
-        ]
-
-        for r in round_btc_bins:
-            amount_above = output_bell_curve_bin_counts[r + 1]
-            amount_below = output_bell_curve_bin_counts[r - 1]
-            output_bell_curve_bin_counts[r] = 0.5 * (amount_above + amount_below)
-
-        curve_sum = 0.0
-        for n in range(201, 1601):
-            curve_sum += output_bell_curve_bin_counts[n]
-
-        for n in range(201, 1601):
-            output_bell_curve_bin_counts[n] /= curve_sum
-            if output_bell_curve_bin_counts[n] > 0.008:
-                output_bell_curve_bin_counts[n] = 0.008
-
-        ###############################################################################
-        # Part 8) Construct the USD price finder stencils
-        ###############################################################################
-
-        num_elements = 803
-        mean = 411
-        std_dev = 201
-
-        smooth_stencil = []
-        for x in range(num_elements):
-            exp_part = -((x - mean) ** 2) / (2 * (std_dev ** 2))
-            smooth_stencil.append((0.00150 * 2.718281828459045 ** exp_part) + (0.0000005 * x))
-
-        spike_stencil = [0.0] * 803
-        spike_stencil[40] = 0.001300198324984352
-        spike_stencil[141] = 0.001676746949820743
-        spike_stencil[201] = 0.003468805546942046
-        spike_stencil[202] = 0.001991977522512513
-        spike_stencil[236] = 0.001905066647961839
-        spike_stencil[261] = 0.003341772718156079
-        spike_stencil[262] = 0.002588902624584287
-        spike_stencil[296] = 0.002577893841190244
-        spike_stencil[297] = 0.002733728814200412
-        spike_stencil[340] = 0.003076117748975647
-        spike_stencil[341] = 0.005613067550103145
-        spike_stencil[342] = 0.003088253178535568
-        spike_stencil[400] = 0.002918457489366139
-        spike_stencil[401] = 0.006174500465286022
-        spike_stencil[402] = 0.004417068070043504
-        spike_stencil[403] = 0.002628663628020371
-        spike_stencil[436] = 0.002858828161543839
-        spike_stencil[461] = 0.004097463611984264
-        spike_stencil[462] = 0.003345917406120509
-        spike_stencil[496] = 0.002521467726855856
-        spike_stencil[497] = 0.002784125730361008
-        spike_stencil[541] = 0.003792850444811335
-        spike_stencil[601] = 0.003688240815848247
-        spike_stencil[602] = 0.002392400117402263
-        spike_stencil[636] = 0.001280993059008106
-        spike_stencil[661] = 0.001654665137536031
-        spike_stencil[662] = 0.001395501347054946
-        spike_stencil[741] = 0.001154279140906312
-        spike_stencil[801] = 0.000832244504868709
-
-        ###############################################################################
-        # Part 9) Estimate the price using the best fit stencil slide
-        ###############################################################################
-
-        best_slide = 0
-        best_slide_score = 0
-        total_score = 0
-        smooth_weight = 0.65
-        spike_weight = 1
-
-        center_p001 = 601
-        left_p001 = center_p001 - int((len(spike_stencil) + 1) / 2)
-        right_p001 = center_p001 + int((len(spike_stencil) + 1) / 2)
-
-        min_slide = -141
-        max_slide = 201
+    blocks.close()
+    stats.observe_phase('part6_read_blocks', time.perf_counter() - started)
 
+    if cross_check_counts is not None:
+        if list(cross_check_counts) == list(output_bell_curve_bin_counts):
+            print(f"\nCross-check: raw and json histograms are identical ({int(sum(cross_check_counts))} outputs)")
+        else:
+            differing_bins = [n for n in range(number_of_bins) if cross_check_counts[n] != output_bell_curve_bin_counts[n]]
+            print(f"\nCross-check: raw and json histograms differ in {len(differing_bins)} bins")
+
+    # Parts 7-9 modify the bell curve, so keep the Part 6 counts for the day store
+    if np is not None:
+        day_counts = output_bell_curve_bin_counts.copy()
+    else:
+        day_counts = array('d', output_bell_curve_bin_counts)
+
+    started = time.perf_counter()
+    fit = fit_bell_curve(output_bell_curve_bin_counts)
+    stats.observe_phase('part7_9_fit', time.perf_counter() - started)
+
+    # Only days the tip has moved past are final
+    if day_store is not None and latest_time_in_seconds >= price_day_seconds + seconds_in_a_day:
+        day_store.put(datetime_entered, day_counts, price_day_block, price_day_last_block_read,
+                      block_hash_at(price_day_last_block_read), block_count, block_hash_at(block_count), fit['price'])
+
+    return price_result(datetime_entered, fit, price_day_block, price_day_last_block_read)
+
+def price_result(datetime_entered, fit, first_block, last_block):
+    """The result of estimate_price for a day, from its fit_bell_curve() result and block range."""
+    return {'date': datetime_entered.strftime("%Y-%m-%d"), 'price': fit['price'],
+            'first_block': first_block, 'last_block': last_block,
+            'best_slide': fit['best_slide'], 'best_slide_score': float(fit['best_slide_score']),
+            'second_slide': fit['best_slide'] + fit['best_neighbor'],
+            'second_slide_score': float(fit['neighbor_score']), 'avg_score': float(fit['avg_score'])}
+
+def block_hash_at(height):
+    """Hash of the active chain's block at height, from the header index if open."""
+    if header_index is not None:
+        return header_index.hash_at(height)
+    return Ask_Node(['getblockhash', str(height)]).decode()
+
+def stored_day(datetime_entered):
+    """The day store's record of a day, if its last block is still in the active chain.
+
+    A day whose last block was reorged out is dropped from the store.
+    """
+    if day_store is None:
+        return None
+    stored = day_store.get(datetime_entered)
+    if stored is None:
+        return None
+    try:
+        if header_index is not None and stored['last_block'] > header_index.tip_height:
+            current = False
+        else:
+            current = block_hash_at(stored['last_block']) == stored['last_block_hash']
+    except Exception:
+        current = False  # the node no longer has a block at that height
+    if not current:
+        day_store.invalidate(datetime_entered)
+        return None
+    return stored
+
+# Round BTC amounts whose bins Part 7 smooths over (their outputs are not USD amounts)
+round_btc_amounts = [
+    0.00001, 0.0001, 0.0002, 0.0003, 0.0005, 0.001, 0.002, 0.003, 0.005,
+    0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.3, 0.5, 1
+]
+
+def build_round_btc_bins(output_bell_curve_bins):
+    """Bin of each round BTC amount (at 200 bins per decade: 201, 401, 461, 496, ..., 1201)."""
+    return [bisect_right(output_bell_curve_bins, amount) - 1 for amount in round_btc_amounts]
+
+# The spike stencil at 200 bins per decade, by stencil position: the weight of the
+# round USD amounts (and their neighbouring bins) relative to $100 at position 402
+spike_stencil_weights = {
+    40: 0.001300198324984352, 141: 0.001676746949820743, 201: 0.003468805546942046,
+    202: 0.001991977522512513, 236: 0.001905066647961839, 261: 0.003341772718156079,
+    262: 0.002588902624584287, 296: 0.002577893841190244, 297: 0.002733728814200412,
+    340: 0.003076117748975647, 341: 0.005613067550103145, 342: 0.003088253178535568,
+    400: 0.002918457489366139, 401: 0.006174500465286022, 402: 0.004417068070043504,
+    403: 0.002628663628020371, 436: 0.002858828161543839, 461: 0.004097463611984264,
+    462: 0.003345917406120509, 496: 0.002521467726855856, 497: 0.002784125730361008,
+    541: 0.003792850444811335, 601: 0.003688240815848247, 602: 0.002392400117402263,
+    636: 0.001280993059008106, 661: 0.001654665137536031, 662: 0.001395501347054946,
+    741: 0.001154279140906312, 801: 0.000832244504868709,
+}
+
+def build_price_finder_stencils(bins_per_decade=200):
+    """The smooth and spike stencils of Part 8, matched against the bell curve in Part 9.
+
+    The stencils were designed at 200 bins per decade, 803 positions with $100 at
+    position 402. At another resolution each stencil bin takes the smooth curve at
+    its position and the average spike weight over the 200-per-decade bins it spans,
+    so a slide scores about the same at any resolution.
+    """
+    num_elements = 4 * bins_per_decade + 3
+    center = 2 * bins_per_decade + 2
+    width = 200 / bins_per_decade  # stencil bin width in 200-per-decade bins
+    mean = 411
+    std_dev = 201
+
+    smooth_stencil = []
+    for x in range(num_elements):
+        position = 402 + (x - center) * width
+        exp_part = -((position - mean) ** 2) / (2 * (std_dev ** 2))
+        smooth_stencil.append((0.00150 * 2.718281828459045 ** exp_part) + (0.0000005 * position))
+
+    spike_stencil = [0.0] * num_elements
+    for x in range(num_elements):
+        start = 402 + (x - center) * width
+        weight = 0.0
+        for n in range(int(start // 1), int(-(-(start + width) // 1))):
+            if n in spike_stencil_weights:
+                overlap = min(n + 1, start + width) - max(n, start)
+                weight += spike_stencil_weights[n] * overlap
+        spike_stencil[x] = weight / width
+
+    return smooth_stencil, spike_stencil
+
+# Round BTC bins (Part 7) and USD price finder stencils (Part 8), built once for the
+# current bins per decade; set_bins_per_decade() rebuilds them with the bins
+round_btc_bins = build_round_btc_bins(output_bell_curve_bins)
+smooth_stencil, spike_stencil = build_price_finder_stencils()
+
+def set_bins_per_decade(resolution):
+    """Rebuild the bins, round BTC bins and stencils for another bell curve resolution."""
+    global bins_per_decade, output_bell_curve_bins, bell_curve_bin_edges, round_btc_bins
+    global smooth_stencil, spike_stencil
+    bins_per_decade = resolution
+    output_bell_curve_bins = build_bell_curve_bins(resolution)
+    bell_curve_bin_edges = np.array(output_bell_curve_bins) if np is not None else output_bell_curve_bins
+    round_btc_bins = build_round_btc_bins(output_bell_curve_bins)
+    smooth_stencil, spike_stencil = build_price_finder_stencils(resolution)
+
+def initialize_fit(args):
+    """Apply --bins-per-decade and --sub-bin, before initialize_caches picks the day store."""
+    global sub_bin_interpolation
+    if args.bins_per_decade < 10:
+        raise ValueError("--bins-per-decade must be at least 10")
+    if args.bins_per_decade != bins_per_decade:
+        set_bins_per_decade(args.bins_per_decade)
+    sub_bin_interpolation = args.sub_bin
+
+# Above this many multiply-adds per stencil, slides are scored with an FFT
+fft_correlation_threshold = 1 << 20
+
+def correlate_stencil(curve_segment, stencil):
+    """The stencil's dot product with every window of curve_segment (numpy arrays)."""
+    if len(curve_segment) * len(stencil) <= fft_correlation_threshold:
+        return np.correlate(curve_segment, stencil, mode='valid')
+    size = 1 << (len(curve_segment) + len(stencil)).bit_length()
+    spectrum = np.fft.rfft(curve_segment, size) * np.conj(np.fft.rfft(stencil, size))
+    return np.fft.irfft(spectrum, size)[:len(curve_segment) - len(stencil) + 1]
+
+def fit_bell_curve(output_bell_curve_bin_counts):
+    """Run Parts 7-9 on a bell curve of output amounts (modified in place).
+
+    Returns the price estimate with the best fitting stencil slide, its best
+    neighbouring slide and their scores.
+    """
+    # Bin positions at the current resolution (at 200 bins per decade: 201, 1601 and 601)
+    bin_1e_5_btc = 1 + bins_per_decade
+    bin_1e2_btc = 1 + 8 * bins_per_decade
+    center_p001 = 1 + 3 * bins_per_decade
+
+    ###############################################################################
+    # Part 7) Remove non-usd related outputs from the bell curve
+    ###############################################################################
+
+    for n in range(0, bin_1e_5_btc):
+        output_bell_curve_bin_counts[n] = 0
+    for n in range(bin_1e2_btc, len(output_bell_curve_bin_counts)):
+        output_bell_curve_bin_counts[n] = 0
+
+    for r in round_btc_bins:
+        amount_above = output_bell_curve_bin_counts[r + 1]
+        amount_below = output_bell_curve_bin_counts[r - 1]
+        output_bell_curve_bin_counts[r] = 0.5 * (amount_above + amount_below)
+
+    curve_sum = 0.0
+    for n in range(bin_1e_5_btc, bin_1e2_btc):
+        curve_sum += output_bell_curve_bin_counts[n]
+
+    # A bin's share is capped at 0.008 at 200 bins per decade, less for narrower bins
+    max_bin_share = 0.008 * 200 / bins_per_decade if bins_per_decade != 200 else 0.008
+    for n in range(bin_1e_5_btc, bin_1e2_btc):
+        output_bell_curve_bin_counts[n] /= curve_sum
+        if output_bell_curve_bin_counts[n] > max_bin_share:
+            output_bell_curve_bin_counts[n] = max_bin_share
+
+    ###############################################################################
+    # Part 8) Construct the USD price finder stencils
+    ###############################################################################
+
+    # The stencils are built once at startup by build_price_finder_stencils()
+
+    ###############################################################################
+    # Part 9) Estimate the price using the best fit stencil slide
+    ###############################################################################
+
+    best_slide = 0
+    best_slide_score = 0
+    total_score = 0
+    smooth_weight = 0.65
+    spike_weight = 1
+
+    left_p001 = center_p001 - int((len(spike_stencil) + 1) / 2)
+    right_p001 = center_p001 + int((len(spike_stencil) + 1) / 2)
+
+    # -141 to 200 bins at 200 bins per decade; the smooth stencil counts below slide 150
+    min_slide = round(-141 * bins_per_decade / 200)
+    max_slide = round(201 * bins_per_decade / 200)
+
+    if np is not None:
+        # Score every slide at once: slide s matches the stencils against the curve
+        # from left_p001 + s on
+        curve = np.asarray(output_bell_curve_bin_counts, dtype=np.float64)
+        curve_segment = curve[left_p001 + min_slide:left_p001 + max_slide - 1 + len(spike_stencil)]
+        slides = np.arange(min_slide, max_slide)
+        slide_scores = correlate_stencil(curve_segment, np.array(spike_stencil))
+        smooth_scores = correlate_stencil(curve_segment, np.array(smooth_stencil))
+        slide_scores = np.where(200 * slides < 150 * bins_per_decade, slide_scores + smooth_scores * 0.65,
+                                slide_scores)
+        best_index = int(np.argmax(slide_scores))
+        if slide_scores[best_index] > best_slide_score:
+            best_slide_score = float(slide_scores[best_index])
+            best_slide = min_slide + best_index
+        total_score = float(slide_scores.sum())
+        slide_scores = slide_scores.tolist()
+    else:
+        slide_scores = []
         for slide in range(min_slide, max_slide):
             shifted_curve = output_bell_curve_bin_counts[left_p001 + slide:right_p001 + slide]
             slide_score_smooth = 0.0
@@ -431,46 +2390,833 @@ try:
             slide_score = 0.0
             for n in range(0, len(spike_stencil)):
                 slide_score += shifted_curve[n] * spike_stencil[n]
-            if slide < 150:
+            if 200 * slide < 150 * bins_per_decade:
                 slide_score = slide_score + slide_score_smooth * 0.65
             if slide_score > best_slide_score:
                 best_slide_score = slide_score
                 best_slide = slide
             total_score += slide_score
+            slide_scores.append(slide_score)
+
+    usd100_in_btc_best = output_bell_curve_bins[center_p001 + best_slide]
+    btc_in_usd_best = 100 / (usd100_in_btc_best)
+
+    neighbor_up = output_bell_curve_bin_counts[left_p001 + best_slide + 1:right_p001 + best_slide + 1]
+    neighbor_up_score = 0.0
+    for n in range(0, len(spike_stencil)):
+        neighbor_up_score += neighbor_up[n] * spike_stencil[n]
+
+    neighbor_down = output_bell_curve_bin_counts[left_p001 + best_slide - 1:right_p001 + best_slide - 1]
+    neighbor_down_score = 0.0
+    for n in range(0, len(spike_stencil)):
+        neighbor_down_score += neighbor_down[n] * spike_stencil[n]
+
+    best_neighbor = +1
+    neighbor_score = neighbor_up_score
+    if neighbor_down_score > neighbor_up_score:
+        best_neighbor = -1
+        neighbor_score = neighbor_down_score
+
+    usd100_in_btc_2nd = output_bell_curve_bins[center_p001 + best_slide + best_neighbor]
+    btc_in_usd_2nd = 100 / (usd100_in_btc_2nd)
+
+    avg_score = total_score / len(range(min_slide, max_slide))
+    a1 = best_slide_score - avg_score
+    a2 = abs(neighbor_score - avg_score)
+    w1 = a1 / (a1 + a2)
+    w2 = a2 / (a1 + a2)
+    price_estimate = int(w1 * btc_in_usd_best + w2 * btc_in_usd_2nd)
+
+    # Optionally place the peak between bins with a parabola through the best slide's
+    # score and its neighbours' instead of weighting the best and best neighbouring bins
+    sub_bin_offset = None
+    if sub_bin_interpolation and min_slide < best_slide < max_slide - 1:
+        score_down, score, score_up = slide_scores[best_slide - min_slide - 1:best_slide - min_slide + 2]
+        curvature = score_down - 2 * score + score_up
+        sub_bin_offset = 0.5 * (score_down - score_up) / curvature if curvature < 0 else 0.0
+        usd100_in_btc = 10 ** ((center_p001 + best_slide + sub_bin_offset - 1) / bins_per_decade - 6)
+        price_estimate = int(100 / usd100_in_btc)
+
+    return {'price': price_estimate, 'best_slide': best_slide, 'best_slide_score': best_slide_score,
+            'best_neighbor': best_neighbor, 'neighbor_score': neighbor_score, 'avg_score': avg_score,
+            'sub_bin_offset': sub_bin_offset}
+
+###############################################################################
+# Batch mode: estimate a range of dates without prompting
+###############################################################################
+
+def parse_date(date_string):
+    year, month, day = (int(x) for x in date_string.split('-'))
+    return datetime(year, month, day, 0, 0, 0, tzinfo=timezone.utc)
+
+def initialize_worker(args):
+    """Give each batch worker process its own SSH session and cache handles."""
+    sys.stdout = sys.stderr
+    initialize_fit(args)
+    initialize_node(args)
+    initialize_caches(args)
+
+def estimate_price_worker(date_string, block_count, latest_time_in_seconds, args):
+    """Estimate one day in a worker process, returning the result and the stats collected for it."""
+    stats.reset()
+    result = estimate_price(parse_date(date_string), block_count, latest_time_in_seconds, args, verbose=False)
+    return result, stats.to_dict()
+
+def read_completed_dates(path, output_format):
+    """Dates already written to an earlier (possibly interrupted) batch output file."""
+    completed = set()
+    if not os.path.exists(path):
+        return completed
+    with open(path, 'r+') as f:
+        text = f.read()
+        # Drop a partly written last line so appended results start on a fresh line
+        if text and not text.endswith('\n'):
+            text = text[:text.rfind('\n') + 1]
+            f.truncate(len(text))
+    for line in text.splitlines():
+        try:
+            if output_format == 'json':
+                completed.add(json.loads(line)['date'])
+            elif not line.startswith('date,'):
+                completed.add(line.split(',')[0])
+        except (ValueError, KeyError):
+            continue
+    return completed
+
+def write_result(results_file, result, output_format):
+    if output_format == 'json':
+        results_file.write(json.dumps(result) + '\n')
+    else:
+        results_file.write(f"{result['date']},{result['price']},{result['first_block']},{result['last_block']}\n")
+    results_file.flush()
+
+def run_batch(args, results_file):
+    """Estimate every date from --date or --start/--end, writing each day as it completes.
+
+    Returns the exit status: 0 once every date is written, 1 for bad dates.
+    """
+    block_count, latest_time_in_seconds, latest_utc_midnight = get_latest_block()
+
+    try:
+        first_date = parse_date(args.date or args.start)
+        last_date = parse_date(args.date or args.end or args.start)
+    except ValueError:
+        print("Error interpreting date. Make sure format is YYYY-MM-DD")
+        return 1
+    earliest_date = datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)
+    latest_date = latest_utc_midnight + timedelta(days=-1)
+    if first_date < earliest_date or last_date > latest_date or first_date > last_date:
+        print(f"Dates must be complete days between {earliest_date.strftime('%Y-%m-%d')} "
+              f"and {latest_date.strftime('%Y-%m-%d')}")
+        return 1
+
+    dates = []
+    while first_date <= last_date:
+        dates.append(first_date.strftime("%Y-%m-%d"))
+        first_date += timedelta(days=1)
+
+    completed = set()
+    if args.output_file:
+        completed = read_completed_dates(args.output_file, args.output)
+        results_file = open(args.output_file, 'a')
+    if args.output == 'csv' and not completed and (not args.output_file or results_file.tell() == 0):
+        results_file.write("date,price,first_block,last_block\n")
+    dates = [d for d in dates if d not in completed]
+    print(f"Estimating {len(dates)} days ({len(completed)} already in the output file)")
 
-        usd100_in_btc_best = output_bell_curve_bins[center_p001 + best_slide]
-        btc_in_usd_best = 100 / (usd100_in_btc_best)
+    try:
+        if args.workers <= 1:
+            for date_string in dates:
+                result = estimate_price(parse_date(date_string), block_count, latest_time_in_seconds, args, verbose=False)
+                write_result(results_file, result, args.output)
+                print(f"{date_string}: ${result['price']:,}")
+            return 0
+
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=context,
+                                 initializer=initialize_worker, initargs=(args,)) as pool:
+            futures = {pool.submit(estimate_price_worker, d, block_count, latest_time_in_seconds, args): d
+                       for d in dates}
+            try:
+                for future in as_completed(futures):
+                    result, worker_stats = future.result()
+                    stats.merge(worker_stats)
+                    write_result(results_file, result, args.output)
+                    print(f"{futures[future]}: ${result['price']:,}")
+            except BaseException:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+        return 0
+    finally:
+        # results_file is the real stdout unless opened above (main points sys.stdout at stderr)
+        if args.output_file:
+            results_file.close()
+
+def run_refit(args):
+    """Rerun Parts 7-9 over every day in the day store, updating the stored estimates.
+
+    Without the node, days whose blocks were since reorged out are not noticed
+    until they are next estimated.
+    """
+    if day_store is None:
+        print("--refit needs the day store (drop --no-day-store)")
+        return
+    for day in day_store.days():
+        stored = day_store.get(day)
+        started = time.perf_counter()
+        fit = fit_bell_curve(stored['counts'])
+        stats.observe_phase('part7_9_fit', time.perf_counter() - started)
+        if fit['price'] == stored['price']:
+            print(f"{stored['date']}: ${fit['price']:,}")
+        else:
+            day_store.set_price(day, fit['price'])
+            print(f"{stored['date']}: ${fit['price']:,} (was ${stored['price']:,})")
+
+###############################################################################
+# Rolling mode: estimate over a sliding window of the most recent blocks
+###############################################################################
+
+def add_bell_curves(output_bell_curve_bin_counts, block_bin_counts, sign):
+    """Add (sign=1) or subtract (sign=-1) one block's bin counts from a bell curve."""
+    if np is not None:
+        output_bell_curve_bin_counts += sign * block_bin_counts
+    else:
+        for n, count in enumerate(block_bin_counts):
+            if count:
+                output_bell_curve_bin_counts[n] += sign * count
+
+class RollingBellCurve:
+    """Bell curve over a sliding window of recent blocks, updated one block at a time.
+
+    Each block keeps its own bin counts so the oldest block can be subtracted when
+    the window moves, and only Parts 7-9 are rerun for a new estimate. A block's
+    outputs are filtered against the txids already in the window when it is added
+    and are not re-filtered when older blocks later leave the window.
+    """
+
+    def __init__(self, window_blocks=None, window_seconds=None):
+        self.window_blocks = window_blocks
+        self.window_seconds = window_seconds
+        self.blocks = deque()  # (height, block hash or None, BlockCandidates, block bin counts)
+        self.window_txids = Counter()
+        self.output_bell_curve_bin_counts = empty_bell_curve(len(output_bell_curve_bins))
+
+    @property
+    def last_height(self):
+        return self.blocks[-1][0] if self.blocks else None
+
+    def add(self, height, block_hash, block):
+        block_bin_counts = empty_bell_curve(len(output_bell_curve_bins))
+        bin_block_outputs(block, self.window_txids, bell_curve_bin_edges, block_bin_counts)
+        add_bell_curves(self.output_bell_curve_bin_counts, block_bin_counts, 1)
+        self.blocks.append((height, block_hash, block, block_bin_counts))
+        while self.blocks and (
+                (self.window_blocks and len(self.blocks) > self.window_blocks) or
+                (self.window_seconds and self.blocks[0][2].time <= block.time - self.window_seconds)):
+            self.remove_oldest()
+
+    def remove_oldest(self):
+        height, block_hash, block, block_bin_counts = self.blocks.popleft()
+        add_bell_curves(self.output_bell_curve_bin_counts, block_bin_counts, -1)
+        for txid in block.txids:
+            self.window_txids[txid] -= 1
+            if not self.window_txids[txid]:
+                del self.window_txids[txid]
+
+    def estimate(self):
+        """Price estimate over the blocks currently in the window."""
+        if np is not None:
+            fit = fit_bell_curve(self.output_bell_curve_bin_counts.copy())
+        else:
+            fit = fit_bell_curve(array('d', self.output_bell_curve_bin_counts))
+        first_block, last_block = self.blocks[0][2], self.blocks[-1][2]
+        return {'price': fit['price'], 'first_block': self.blocks[0][0], 'last_block': self.blocks[-1][0],
+                'first_block_time': first_block.time, 'last_block_time': last_block.time,
+                'blocks': len(self.blocks)}
+
+def update_rolling_window(window, block_count, args):
+    """Add any blocks mined since the window's last block, starting the window if needed."""
+    if window.last_height is not None and header_index is not None and \
+            (window.last_height > header_index.tip_height or
+             header_index.hash_at(window.last_height) != window.blocks[-1][1]):
+        print("Rolling window: reorg detected, rebuilding the window")
+        while window.blocks:
+            window.remove_oldest()
+
+    if window.last_height is not None:
+        first_height = window.last_height + 1
+    elif window.window_seconds and header_index is not None:
+        first_height = header_index.first_height_at_or_after(header_index.time_at(block_count) - window.window_seconds)
+    elif window.window_seconds:
+        first_height = block_count - int(window.window_seconds / 600 * 1.5)  # about 1.5x the expected blocks
+    else:
+        first_height = block_count - window.window_blocks + 1
+
+    blocks = fetch_blocks(first_height, block_count, args.fetch_threads, args.prefetch,
+                          header_index, block_cache, args.block_format)
+    for block_height, block in blocks:
+        block_hash = header_index.hash_at(block_height) if header_index is not None else None
+        window.add(block_height, block_hash, block)
+    blocks.close()
+
+def start_rolling_window(args):
+    window_seconds = args.rolling_hours * 3600 if args.rolling_hours else None
+    return RollingBellCurve(args.rolling_blocks, window_seconds)
+
+def print_rolling_estimate(estimate):
+    first_time = datetime.fromtimestamp(estimate['first_block_time'], tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+    last_time = datetime.fromtimestamp(estimate['last_block_time'], tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+    print(f"Rolling estimate over blocks {estimate['first_block']}-{estimate['last_block']} "
+          f"({first_time} to {last_time} utc): ${estimate['price']:,}")
+
+def run_rolling(args):
+    """Follow the chain tip, printing a new window estimate for every new block."""
+    window = start_rolling_window(args)
+    last_block_count = None
+    while True:
+        block_count, _, _ = get_latest_block()
+        if block_count != last_block_count:
+            update_rolling_window(window, block_count, args)
+            print_rolling_estimate(window.estimate())
+            last_block_count = block_count
+        time.sleep(args.poll_seconds)
+
+###############################################################################
+# Mempool mode: a provisional estimate from unconfirmed transactions
+###############################################################################
+
+# getrawtransaction calls per batched round trip when reading new mempool transactions
+mempool_page_size = 500
+
+# With fewer candidate transactions than this in the mempool there is no provisional estimate
+mempool_min_candidates = 1000
+
+def extract_raw_transactions_candidates(raw_transactions):
+    """Part 6 candidates of some serialized transactions, parsed as a block holding just them."""
+    # A zeroed header (the mempool has no block time) and a 4-byte CompactSize count
+    raw_block = b''.join([bytes(80), b'\xfe', struct.pack('<I', len(raw_transactions))] + raw_transactions)
+    return extract_raw_block_candidates(raw_block)
+
+def read_mempool_transactions(txids):
+    """Serialized transactions of some mempool txids, None for those that left the mempool meanwhile."""
+    answers = Ask_Node_Batch([['getrawtransaction', txid] for txid in txids], missing_ok=True)
+    return [bytes.fromhex(answer.decode()) if answer else None for answer in answers]
+
+class MempoolBellCurve:
+    """Bell curve of the Part 6 candidates in the node's mempool, kept up to date by polling.
+
+    Each poll reads only the transactions that entered the mempool since the last one
+    and subtracts the outputs of those that left it (mined, replaced or evicted), so
+    the mempool is never rescanned. In place of the same-day input filter, transactions
+    spending an output of another mempool transaction are left out. Like a rolling
+    window block, a transaction is filtered once, when it enters.
+    """
+
+    def __init__(self):
+        self.txids = set()  # txids in the mempool at the last poll
+        self.txid_suffixes = Counter()  # their last 4 bytes, as BlockCandidates keeps them
+        self.output_values = {}  # txid -> candidate output values counted in the bell curve
+        self.output_bell_curve_bin_counts = empty_bell_curve(len(output_bell_curve_bins))
+        self.updated = None
+
+    def update(self, fetch_threads=1):
+        """Poll getrawmempool and count the transactions that entered and left since the last poll."""
+        started = time.perf_counter()
+        mempool = set(json.loads(Ask_Node(['getrawmempool', 'false'])))
+        departed = self.txids - mempool
+        entered = list(mempool - self.txids)
+
+        departed_values = []
+        for txid in departed:
+            departed_values.extend(self.output_values.pop(txid, ()))
+            suffix = int(txid[-8:], 16)
+            self.txid_suffixes[suffix] -= 1
+            if not self.txid_suffixes[suffix]:
+                del self.txid_suffixes[suffix]
+        self.txids -= departed
+        departed_counts = empty_bell_curve(len(output_bell_curve_bins))
+        bin_output_values(departed_values, bell_curve_bin_edges, departed_counts)
+        add_bell_curves(self.output_bell_curve_bin_counts, departed_counts, -1)
+
+        # Every entering txid is known before any entering transaction is filtered, so a
+        # child is left out whichever page its parent is read in
+        self.txids.update(entered)
+        self.txid_suffixes.update(int(txid[-8:], 16) for txid in entered)
+        pages = [entered[i:i + mempool_page_size] for i in range(0, len(entered), mempool_page_size)]
+        entered_values = []
+        with ThreadPoolExecutor(max_workers=max(1, fetch_threads)) as executor:
+            for page, raw_transactions in zip(pages, executor.map(read_mempool_transactions, pages)):
+                present = [(txid, raw) for txid, raw in zip(page, raw_transactions) if raw is not None]
+                block = extract_raw_transactions_candidates([raw for _, raw in present])
+                for tx_index, input_txids, candidate_values in block.candidates:
+                    if any(input_txid in self.txid_suffixes for input_txid in input_txids):
+                        continue
+                    self.output_values[present[tx_index][0]] = candidate_values
+                    entered_values.extend(candidate_values)
+        bin_output_values(entered_values, bell_curve_bin_edges, self.output_bell_curve_bin_counts)
+
+        self.updated = int(time.time())
+        stats.observe_phase('mempool_update', time.perf_counter() - started)
+        return len(entered), len(departed)
+
+    def estimate(self):
+        """Provisional price estimate over the mempool at the last poll, or None with too few candidates."""
+        if len(self.output_values) < mempool_min_candidates:
+            return None
+        if np is not None:
+            fit = fit_bell_curve(self.output_bell_curve_bin_counts.copy())
+        else:
+            fit = fit_bell_curve(array('d', self.output_bell_curve_bin_counts))
+        return {'price': fit['price'], 'provisional': True, 'transactions': len(self.txids),
+                'candidates': len(self.output_values), 'updated': self.updated}
+
+def print_mempool_estimate(estimate, confirmed):
+    confirmed_text = f"confirmed {confirmed['date']}: ${confirmed['price']:,}"
+    if estimate is None:
+        print(f"Provisional mempool estimate: not enough candidate transactions yet; {confirmed_text}")
+        return
+    updated = datetime.fromtimestamp(estimate['updated'], tz=timezone.utc).strftime("%H:%M:%S")
+    print(f"Provisional mempool estimate: ${estimate['price']:,} ({estimate['candidates']:,} candidates of "
+          f"{estimate['transactions']:,} transactions at {updated} utc); {confirmed_text}")
+
+def run_mempool(args):
+    """Poll the mempool, printing a provisional estimate next to the last confirmed day's price."""
+    mempool = MempoolBellCurve()
+    confirmed = None
+    while True:
+        block_count, latest_time_in_seconds, latest_utc_midnight = get_latest_block()
+        confirmed_day = latest_utc_midnight - timedelta(days=1)
+        if confirmed is None or confirmed['date'] != confirmed_day.strftime("%Y-%m-%d"):
+            confirmed = estimate_price(confirmed_day, block_count, latest_time_in_seconds, args, verbose=False)
+        mempool.update(args.fetch_threads)
+        print_mempool_estimate(mempool.estimate(), confirmed)
+        time.sleep(args.poll_seconds)
+
+###############################################################################
+# Daemon mode: follow the chain tip and serve finished days over HTTP
+###############################################################################
+
+class PriceRequestHandler(BaseHTTPRequestHandler):
+    """GET /latest, /price/YYYY-MM-DD, /prices, /rolling or /mempool, answered from the daemon's memory."""
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = stats.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        prices = self.server.prices
+        with self.server.prices_lock:
+            if self.path == '/rolling':
+                answer = self.server.rolling_estimate
+            elif self.path == '/mempool' and self.server.mempool_estimate is not None:
+                answer = dict(self.server.mempool_estimate, confirmed=prices[max(prices)] if prices else None)
+            elif self.path == '/stats':
+                answer = stats.to_dict()
+            elif self.path == '/latest' and prices:
+                answer = prices[max(prices)]
+            elif self.path == '/prices':
+                answer = [prices[date] for date in sorted(prices)]
+            elif self.path.startswith('/price/') and self.path[len('/price/'):] in prices:
+                answer = prices[self.path[len('/price/'):]]
+            else:
+                answer = None
+        body = json.dumps(answer if answer is not None else {'error': 'not found'}).encode()
+        self.send_response(200 if answer is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_daemon(args):
+    """Keep the node connection open, estimate each UTC day once its blocks are mined,
+    and serve the results from memory over a local HTTP/JSON endpoint."""
+    server = ThreadingHTTPServer((args.http_host, args.http_port), PriceRequestHandler)
+    server.prices = {}
+    server.prices_lock = threading.Lock()
+    server.rolling_estimate = None
+    server.mempool_estimate = None
+    rolling_window = None
+    if args.rolling_blocks or args.rolling_hours:
+        rolling_window = start_rolling_window(args)
+    mempool = MempoolBellCurve() if args.mempool else None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving prices on http://{args.http_host}:{args.http_port}/latest")
+
+    earliest_date = datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)
+    last_block_count = None
+    try:
+        while True:
+            try:
+                block_count = int(Ask_Node(['getblockcount']))
+                # last_block_count is only set once a pass has estimated every day, so a
+                # failed pass is redone on the next poll even without a new block
+                if block_count != last_block_count:
+                    block_count, latest_time_in_seconds, latest_utc_midnight = get_latest_block()
+
+                    # Forget days whose last block was reorged out, so they are estimated again
+                    if header_index is not None:
+                        with server.prices_lock:
+                            for date, result in list(server.prices.items()):
+                                if (result['last_block'] > header_index.tip_height or
+                                        header_index.hash_at(result['last_block']) != result['last_block_hash']):
+                                    del server.prices[date]
+
+                    if rolling_window is not None:
+                        update_rolling_window(rolling_window, block_count, args)
+                        with server.prices_lock:
+                            server.rolling_estimate = rolling_window.estimate()
+
+                    # A day is final once the tip's header time has passed the following midnight
+                    day = max(earliest_date, latest_utc_midnight + timedelta(days=-args.backfill_days))
+                    failed_dates = []
+                    while day < latest_utc_midnight:
+                        date_string = day.strftime("%Y-%m-%d")
+                        if date_string not in server.prices:
+                            # One failed day does not hold up the others
+                            try:
+                                result = estimate_price(day, block_count, latest_time_in_seconds, args,
+                                                        verbose=False)
+                                if header_index is not None:
+                                    result['last_block_hash'] = header_index.hash_at(result['last_block'])
+                                else:
+                                    result['last_block_hash'] = Ask_Node(
+                                        ['getblockhash', str(result['last_block'])]).decode()
+                            except Exception as e:
+                                print(f"Error estimating {date_string}, retrying on the next poll: {str(e)}")
+                                failed_dates.append(date_string)
+                            else:
+                                with server.prices_lock:
+                                    server.prices[date_string] = result
+                                print(f"{date_string}: ${result['price']:,} "
+                                      f"(blocks {result['first_block']}-{result['last_block']})")
+                        day += timedelta(days=1)
+                    if not failed_dates:
+                        last_block_count = block_count
+
+                # The mempool changes between blocks, so it is polled every time
+                if mempool is not None:
+                    mempool.update(args.fetch_threads)
+                    with server.prices_lock:
+                        server.mempool_estimate = mempool.estimate()
+            except Exception as e:
+                print(f"Error following the chain tip: {str(e)}")
+                if replay_node is None and (ssh is None or ssh.get_transport() is None or
+                                            not ssh.get_transport().is_active()):
+                    close_ssh()
+                    try:
+                        initialize_node(args)
+                    except SystemExit:
+                        pass  # initialize_ssh exits on failure; retry on the next poll instead
+            time.sleep(args.poll_seconds)
+    finally:
+        server.shutdown()
+
+###############################################################################
+# Library API: estimate prices from other Python programs
+###############################################################################
+
+class Oracle:
+    """Price estimator for embedding in other Python programs:
+
+        with Oracle('192.168.1.99') as oracle:
+            result = oracle.estimate('2024-03-12')
+
+    Other options are the command-line options with underscores (fetch_threads=8,
+    replay='fixtures', ...). The connection, header index and block cache are
+    opened on the first estimate and stay open until close(). They are module
+    globals, so only one Oracle should be open per process. So are the bins and
+    stencils: opening an Oracle whose bins_per_decade or sub_bin differ from
+    another open Oracle's raises ValueError.
+    """
+
+    earliest_date = datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)
+    # Oracles between their first use and close()
+    open_oracles = set()
+
+    def __init__(self, ip='192.168.1.99', transport='auto', **options):
+        self.args = build_argument_parser().parse_args([])
+        self.args.ip = ip
+        self.args.transport = transport
+        for name, value in options.items():
+            if not hasattr(self.args, name):
+                raise TypeError(f"Oracle got an unknown option '{name}'")
+            setattr(self.args, name, value)
+        self.connected = False
+        self.caches_open = False
+
+    def open_caches(self):
+        if not self.caches_open:
+            fit = (self.args.bins_per_decade, self.args.sub_bin)
+            for other in self.open_oracles:
+                if other is not self and (other.args.bins_per_decade, other.args.sub_bin) != fit:
+                    raise ValueError("Another open Oracle uses a different bins_per_decade or sub_bin, "
+                                     "close it first")
+            initialize_fit(self.args)
+            initialize_caches(self.args)
+            self.open_oracles.add(self)
+            self.caches_open = True
+
+    def connect(self):
+        if self.connected:
+            return
+        try:
+            initialize_node(self.args)
+        except SystemExit:
+            raise ConnectionError(f"Could not connect to the node at {self.args.ip}")
+        self.open_caches()
+        self.connected = True
+
+    def stored(self, date):
+        """A day's record from the day store, read without the node, or None.
+
+        It holds the price, block range, last block and tip hashes, and the raw
+        Part 6 bell curve in counts. Use estimate() to recheck it against the chain.
+        """
+        self.open_caches()
+        if day_store is None:
+            return None
+        if isinstance(date, str):
+            return day_store.get(parse_date(date))
+        return day_store.get(datetime(date.year, date.month, date.day, 0, 0, 0, tzinfo=timezone.utc))
+
+    def estimate(self, date):
+        """Estimate the price of one finished UTC day, given as YYYY-MM-DD or a date.
+
+        Returns the estimate_price result: date, price, first_block, last_block,
+        best_slide, best_slide_score, second_slide, second_slide_score, avg_score.
+        """
+        self.connect()
+        if isinstance(date, str):
+            day = parse_date(date)
+        else:
+            day = datetime(date.year, date.month, date.day, 0, 0, 0, tzinfo=timezone.utc)
+        block_count, latest_time_in_seconds, latest_utc_midnight = get_latest_block()
+        if day < self.earliest_date or day >= latest_utc_midnight:
+            raise ValueError(f"{day.strftime('%Y-%m-%d')} is not between 2023-12-15 and "
+                             f"{(latest_utc_midnight + timedelta(days=-1)).strftime('%Y-%m-%d')}")
+        return estimate_price(day, block_count, latest_time_in_seconds, self.args, verbose=False)
+
+    def close(self):
+        close_node()
+        self.connected = False
+        # Reapply this Oracle's bins and reopen its caches if it is used again
+        self.caches_open = False
+        self.open_oracles.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_stats(args):
+    """Print and export the statistics as asked for by --stats, --stats-json and --stats-prom."""
+    if args.stats:
+        print(stats.summary())
+    if args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=2)
+    if args.stats_prom:
+        with open(args.stats_prom, 'w') as f:
+            f.write(stats.to_prometheus())
+
+def build_argument_parser():
+    """The command-line options, also the defaults of the Oracle API."""
+    parser = argparse.ArgumentParser(description="UTXOracle: Estimate Bitcoin price from on-chain data")
+    parser.add_argument('--ip', type=str, default='192.168.1.99',
+                        help="IP address of the Bitcoin node, or several comma-separated nodes to spread "
+                             "block fetches over (default: 192.168.1.99)")
+    parser.add_argument('--transport', choices=['auto', 'rpc', 'exec'], default='auto',
+                        help="auto: RPC tunnel with podman exec fallback, rpc: tunnel only, "
+                             "exec: podman exec only (default: auto)")
+    parser.add_argument('--rpc-host', type=str, default='bitcoind.embassy',
+                        help="bitcoind RPC host as seen from the node (default: bitcoind.embassy)")
+    parser.add_argument('--rpc-port', type=int, default=8332,
+                        help="bitcoind RPC port (default: 8332)")
+    parser.add_argument('--rpc-user', type=str, default=None,
+                        help="RPC username (default: read from the cookie file)")
+    parser.add_argument('--rpc-password', type=str, default=None,
+                        help="RPC password (default: read from the cookie file)")
+    parser.add_argument('--rpc-cookie', type=str, default='/root/.bitcoin/.cookie',
+                        help="cookie file path inside bitcoind.embassy (default: /root/.bitcoin/.cookie)")
+    parser.add_argument('--fetch-threads', type=int, default=4,
+                        help="number of blocks fetched concurrently over separate SSH channels (default: 4)")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="number of blocks requested ahead of the one being processed (default: 8)")
+    parser.add_argument('--cache-dir', type=str, default='~/.sshUTXOracle',
+                        help="directory for the local header index and block cache (default: ~/.sshUTXOracle)")
+    parser.add_argument('--block-format', choices=['raw', 'json', 'json-stream', 'cross-check', 'agent'],
+                        default='raw',
+                        help="raw: parse serialized blocks (getblock 0), json: decode getblock 2, "
+                             "json-stream: decode getblock 2 one transaction at a time as it arrives, "
+                             "cross-check: do raw and json and compare the histograms, "
+                             "agent: filter the blocks on the node with an uploaded python3 script (default: raw)")
+    parser.add_argument('--block-cache-mb', type=int, default=1024,
+                        help="size limit of the local cache of filtered block outputs, 0 disables (default: 1024)")
+    parser.add_argument('--no-header-index', action='store_true',
+                        help="search for the day's blocks on the node instead of using the header index")
+    parser.add_argument('--no-day-store', action='store_true',
+                        help="don't keep finished days' bell curves and estimates under --cache-dir")
+    parser.add_argument('--refit', action='store_true',
+                        help="rerun Parts 7-9 over every day in the day store and exit, without the node")
+    parser.add_argument('--date', type=str, default=None,
+                        help="estimate this YYYY-MM-DD date without prompting")
+    parser.add_argument('--start', type=str, default=None,
+                        help="first YYYY-MM-DD date of a range to estimate without prompting")
+    parser.add_argument('--end', type=str, default=None,
+                        help="last YYYY-MM-DD date of the range (default: --start)")
+    parser.add_argument('--output', choices=['csv', 'json'], default='csv',
+                        help="batch output format, json writes one object per line (default: csv)")
+    parser.add_argument('--output-file', type=str, default=None,
+                        help="append batch results to this file and skip dates already in it (default: stdout)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of batch worker processes, each with its own SSH session (default: 1)")
+    parser.add_argument('--daemon', action='store_true',
+                        help="follow the chain tip and serve finished days over a local HTTP/JSON endpoint")
+    parser.add_argument('--http-host', type=str, default='127.0.0.1',
+                        help="daemon HTTP listen address (default: 127.0.0.1)")
+    parser.add_argument('--http-port', type=int, default=8338,
+                        help="daemon HTTP listen port (default: 8338)")
+    parser.add_argument('--poll-seconds', type=float, default=30,
+                        help="how often the daemon checks getblockcount (default: 30)")
+    parser.add_argument('--backfill-days', type=int, default=7,
+                        help="number of past days the daemon estimates and keeps (default: 7)")
+    parser.add_argument('--rolling-blocks', type=int, default=None,
+                        help="estimate over a sliding window of this many recent blocks, updated per block "
+                             "(served at /rolling in daemon mode)")
+    parser.add_argument('--rolling-hours', type=float, default=None,
+                        help="estimate over a sliding window of the last this many hours of blocks")
+    parser.add_argument('--mempool', action='store_true',
+                        help="poll the node's mempool for a provisional estimate next to the last confirmed "
+                             "day's (served at /mempool in daemon mode)")
+    parser.add_argument('--record', type=str, default=None,
+                        help="save every answer from the node to this directory for offline replay")
+    parser.add_argument('--replay', type=str, default=None,
+                        help="answer node commands from a directory recorded with --record, without SSH")
+    parser.add_argument('--replay-latency', type=float, default=0.0,
+                        help="milliseconds added to each replayed call or batch (default: 0)")
+    parser.add_argument('--txid-bloom', action='store_true',
+                        help="check a Bloom filter before the same-day txid table (needs numpy)")
+    parser.add_argument('--bins-per-decade', type=int, default=200,
+                        help="resolution of the output amounts bell curve and price stencils (default: 200)")
+    parser.add_argument('--sub-bin', action='store_true',
+                        help="place the price between bins by a parabola through the best slide's score "
+                             "and its neighbours'")
+    parser.add_argument('--stats', action='store_true',
+                        help="print node call and per-phase timing statistics at the end")
+    parser.add_argument('--stats-json', type=str, default=None,
+                        help="write the statistics as JSON to this file at the end")
+    parser.add_argument('--stats-prom', type=str, default=None,
+                        help="write the statistics in Prometheus text format to this file at the end")
+    return parser
+
+def main():
+    # Parse command-line arguments
+    args = build_argument_parser().parse_args()
+
+    # In batch mode the results go to stdout and status messages to stderr
+    results_file = sys.stdout
+    batch_mode = args.date is not None or args.start is not None
+    if batch_mode:
+        sys.stdout = sys.stderr
 
-        neighbor_up = output_bell_curve_bin_counts[left_p001 + best_slide + 1:right_p001 + best_slide + 1]
-        neighbor_up_score = 0.0
-        for n in range(0, len(spike_stencil)):
-            neighbor_up_score += neighbor_up[n] * spike_stencil[n]
+    try:
+        initialize_fit(args)
+    except ValueError as e:
+        print(e)
+        return 1
 
-        neighbor_down = output_bell_curve_bin_counts[left_p001 + best_slide - 1:right_p001 + best_slide - 1]
-        neighbor_down_score = 0.0
-        for n in range(0, len(spike_stencil)):
-            neighbor_down_score += neighbor_down[n] * spike_stencil[n]
+    if args.refit:
+        initialize_caches(args)
+        run_refit(args)
+        write_stats(args)
+        return
 
-        best_neighbor = +1
-        neighbor_score = neighbor_up_score
-        if neighbor_down_score > neighbor_up_score:
-            best_neighbor = -1
-            neighbor_score = neighbor_down_score
+    # Initialize SSH connection with the provided or default IP
+    initialize_node(args)
+    initialize_caches(args)
 
-        usd100_in_btc_2nd = output_bell_curve_bins[center_p001 + best_slide + best_neighbor]
-        btc_in_usd_2nd = 100 / (usd100_in_btc_2nd)
+    try:
+        if batch_mode:
+            return run_batch(args, results_file)
+        if args.daemon:
+            run_daemon(args)
+            return
+        if args.rolling_blocks or args.rolling_hours:
+            run_rolling(args)
+            return
+        if args.mempool:
+            run_mempool(args)
+            return
+
+        # Main loop to allow multiple price estimates until 'q'
+        while True:
+            ###############################################################################
+            # Part 2) Get the latest block from the node
+            ###############################################################################
+
+            block_count, latest_time_in_seconds, latest_utc_midnight = get_latest_block()
+
+            seconds_in_a_day = 60 * 60 * 24
+            yesterday_seconds = latest_time_in_seconds - seconds_in_a_day
+            latest_price_day = datetime.fromtimestamp(yesterday_seconds, tz=timezone.utc)
+            latest_price_date = latest_price_day.strftime("%Y-%m-%d")
+
+            print("UTXOracle version 8")
+            print("\nConnected to local node at block #:\t" + str(block_count))
+            print("Latest available price date:\t\t" + latest_price_date + " (pruned node ok)")
+            print("Earliest available price date:\t\t2023-12-15 (requires full node)")
+
+            ###############################################################################
+            # Part 3) Ask the user for the desired date to estimate the price
+            ###############################################################################
+
+            date_entered = input("\nEnter date in YYYY-MM-DD format\nor Enter 'q' to quit " +
+                                 "\nor press ENTER for the most recent price: ")
+
+            if date_entered == 'q':
+                print("Exiting script...")
+                break  # Exit the loop to close SSH and exit
+
+            elif date_entered == "":
+                datetime_entered = latest_utc_midnight + timedelta(days=-1)
+            else:
+                try:
+                    year = int(date_entered.split('-')[0])
+                    month = int(date_entered.split('-')[1])
+                    day = int(date_entered.split('-')[2])
+                    datetime_entered = datetime(year, month, day, 0, 0, 0, tzinfo=timezone.utc)
+                    if datetime_entered.timestamp() > latest_utc_midnight.timestamp():
+                        print("\nThe date entered is not before the current date, please try again")
+                        continue
+                    dec_15_2023 = datetime(2023, 12, 15, 0, 0, 0, tzinfo=timezone.utc)
+                    if datetime_entered.timestamp() < dec_15_2023.timestamp():
+                        print("\nThe date entered is before 2023-12-15, please try again")
+                        continue
+                except:
+                    print("\nError interpreting date. Please try again. Make sure format is YYYY-MM-DD")
+                    continue
 
-        avg_score = total_score / len(range(min_slide, max_slide))
-        a1 = best_slide_score - avg_score
-        a2 = abs(neighbor_score - avg_score)
-        w1 = a1 / (a1 + a2)
-        w2 = a2 / (a1 + a2)
-        price_estimate = int(w1 * btc_in_usd_best + w2 * btc_in_usd_2nd)
+            price_day_date_utc = datetime_entered.strftime("%B %d, %Y")
+            print("\n\n########   Starting Price Estimate   ########")
 
-        print("\nThe " + price_day_date_utc + " btc price estimate is: $" + f'{price_estimate:,}')
+            result = estimate_price(datetime_entered, block_count, latest_time_in_seconds, args)
+            print("\nThe " + price_day_date_utc + " btc price estimate is: $" + f'{result["price"]:,}')
 
-except Exception as e:
-    print(f"\nAn unexpected error occurred: {str(e)}")
-finally:
-    close_ssh()
-    sys.exit(0)
+    except Exception as e:
+        print(f"\nAn unexpected error occurred: {str(e)}")
+        if batch_mode:
+            return 1  # unattended runs must see the failure
+    finally:
+        close_ssh()
+        write_stats(args)
+
+if __name__ == '__main__':
+    sys.exit(main())